@@ -0,0 +1,57 @@
+from __future__ import division
+
+__author__ = 'psinger'
+
+'''
+Benchmark of the block size of distr_chips_hdf5_sparse. The fixed block size of 1000 elements is
+compared with the block size derived from the chunkshape of the stored matrix (see
+hyptrails.pipeline.block_rows). Run from the repository root (or with hyptrails installed):
+
+    PYTHONPATH=. python benchmarks/hdf5_blocks.py [states] [per_row] [repeats]
+'''
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import numpy as np
+from scipy.sparse import csr_matrix
+from hyptrails.hdf5 import hdf5_save, distr_chips_hdf5_sparse
+
+
+def uniform_matrix(states, per_row, seed=42):
+    '''
+    Random hypothesis matrix with per_row elements in each row
+    :param states: number of states (rows and columns)
+    :param per_row: number of elements of each row
+    :param seed: seed of the random number generator
+    :return: csr_matrix
+    '''
+    rng = np.random.RandomState(seed)
+    indptr = np.arange(0, states * per_row + 1, per_row)
+    indices = rng.randint(0, states, states * per_row)
+    return csr_matrix((rng.rand(states * per_row), indices, indptr), shape=(states, states))
+
+
+if __name__ == '__main__':
+    states = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    per_row = int(sys.argv[2]) if len(sys.argv) > 2 else 25
+    repeats = int(sys.argv[3]) if len(sys.argv) > 3 else 3
+
+    folder = tempfile.mkdtemp()
+    try:
+        file = os.path.join(folder, "matrix.hdf5")
+        out = os.path.join(folder, "out.hdf5")
+        hdf5_save(uniform_matrix(states, per_row), file)
+        print("states %d, nnz %d" % (states, states * per_row))
+
+        for name, block_size in [("1000", 1000), ("chunkshape", None)]:
+            times = []
+            for _ in xrange(repeats):
+                t0 = time.time()
+                distr_chips_hdf5_sparse(file, 100, out_name=out, block_size=block_size)
+                times.append(time.time() - t0)
+            print("block_size=%-10s best %6.2f s  median %6.2f s" % (name, min(times), np.median(times)))
+    finally:
+        shutil.rmtree(folder)
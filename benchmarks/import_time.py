@@ -0,0 +1,55 @@
+from __future__ import division
+
+__author__ = 'psinger'
+
+'''
+Import-time benchmark for hyptrails.
+Each import is measured in a fresh interpreter (cold import, as seen by a short-lived
+batch job or a freshly spawned joblib worker). Run from the repository root:
+
+    python benchmarks/import_time.py [repetitions]
+'''
+
+import subprocess
+import sys
+import time
+
+STATEMENTS = [
+    ("python (baseline)", "pass"),
+    ("numpy", "import numpy"),
+    ("hyptrails.trial_roulette", "import hyptrails.trial_roulette"),
+    ("hyptrails.hdf5", "import hyptrails.hdf5"),
+]
+
+CHECK = "import sys, hyptrails.trial_roulette; " \
+        "sys.stdout.write(' '.join(m for m in ('tables', 'joblib', 'scipy') if m in sys.modules))"
+
+
+def cold_import(statement, repetitions):
+    '''
+    Measures the wall time of starting a fresh interpreter and executing statement
+    :param statement: python statement to execute
+    :param repetitions: number of fresh interpreters to start
+    :return: best wall time in seconds
+    '''
+    best = float("inf")
+    for _ in range(repetitions):
+        t0 = time.time()
+        subprocess.check_call([sys.executable, "-c", statement])
+        best = min(best, time.time() - t0)
+    return best
+
+
+if __name__ == '__main__':
+    repetitions = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+
+    for name, statement in STATEMENTS:
+        try:
+            t = cold_import(statement, repetitions)
+        except subprocess.CalledProcessError:
+            print("%-28s not available" % name)
+            continue
+        print("%-28s %8.1f ms" % (name, t * 1000))
+
+    loaded = subprocess.check_output([sys.executable, "-c", CHECK]).decode().strip()
+    print("heavy modules loaded by hyptrails.trial_roulette: %s" % (loaded or "none"))
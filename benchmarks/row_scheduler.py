@@ -0,0 +1,56 @@
+from __future__ import division
+
+__author__ = 'psinger'
+
+'''
+Benchmark of the distr_chips_row schedulers on a matrix with skewed (power-law) row lengths.
+"rows" sends one task per row to joblib; "blocks" shares the CSR arrays via memmaps and hands
+out nnz-balanced row blocks (see hyptrails.parallel). Run from the repository root (or with
+hyptrails installed):
+
+    PYTHONPATH=. python benchmarks/row_scheduler.py [states] [max_jobs]
+'''
+
+import sys
+import time
+import numpy as np
+from scipy.sparse import csr_matrix
+from hyptrails.trial_roulette import distr_chips_row
+
+
+def power_law_matrix(states, alpha=1.2, seed=42):
+    '''
+    Random hypothesis matrix whose row lengths follow a power law
+    :param states: number of states (rows and columns)
+    :param alpha: shape of the Pareto distribution of row lengths
+    :param seed: seed of the random number generator
+    :return: csr_matrix
+    '''
+    rng = np.random.RandomState(seed)
+    lengths = np.minimum((rng.pareto(alpha, states) * 10 + 1).astype(np.int64), states)
+    rows = np.repeat(np.arange(states), lengths)
+    cols = rng.randint(0, states, lengths.sum())
+    matrix = csr_matrix((rng.rand(len(rows)), (rows, cols)), shape=(states, states))
+    matrix.sum_duplicates()
+    return matrix
+
+
+if __name__ == '__main__':
+    states = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    max_jobs = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+
+    matrix = power_law_matrix(states)
+    lengths = np.diff(matrix.indptr)
+    print("states %d, nnz %d, row lengths: median %d, max %d" % (states, matrix.nnz, np.median(lengths),
+                                                                 lengths.max()))
+
+    n_jobs = 1
+    base = {}
+    while n_jobs <= max_jobs:
+        for scheduler in ["rows", "blocks"]:
+            t0 = time.time()
+            distr_chips_row(matrix.copy(), 100, n_jobs=n_jobs, scheduler=scheduler)
+            t = time.time() - t0
+            base.setdefault(scheduler, t)
+            print("%-7s n_jobs=%-3d %8.2f s  speed-up %5.2f" % (scheduler, n_jobs, t, base[scheduler] / t))
+        n_jobs *= 2
@@ -0,0 +1,274 @@
+from __future__ import division
+
+__author__ = 'psinger'
+
+# Single entry point for eliciting Dirichlet priors that picks between the in-memory
+# (trial_roulette) and out-of-core (hdf5) implementations based on the estimated
+# peak memory footprint. PyTables is only imported if an HDF5 file is involved.
+
+import os
+import tempfile
+import numpy as np
+from hyptrails.trial_roulette import distr_chips, distr_chips_row, index_dtype
+
+ENGINES = ["distr_chips", "distr_chips_row", "distr_chips_hdf5_sparse", "distr_chips_hdf5"]
+
+def available_memory():
+    '''
+    Currently available physical memory
+    On Linux this is MemAvailable, which (unlike free memory) includes reclaimable page cache; other
+    platforms fall back to the number of free pages.
+    :return: number of bytes; None if it cannot be determined on this platform
+    '''
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    # the value is given in kB
+                    return int(line.split()[1]) * 1024
+    except (IOError, OSError, ValueError, IndexError):
+        pass
+
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_AVPHYS_PAGES')
+    except (ValueError, AttributeError, OSError):
+        return None
+
+def csr_bytes(n, nnz, dtype=np.float64, idx_dtype=None):
+    '''
+    Size of a csr_matrix
+    :param n: number of rows
+    :param nnz: number of stored elements
+    :param dtype: dtype of the data
+    :param idx_dtype: dtype of indices and indptr; chosen like scipy does if not given
+    :return: number of bytes
+    '''
+    if idx_dtype is None:
+        idx_dtype = index_dtype(nnz)
+    isize = np.dtype(idx_dtype).itemsize
+    return nnz * (np.dtype(dtype).itemsize + isize) + (n + 1) * isize
+
+def estimate_footprint(engine, shape, nnz, dtype=np.float64, mode="integers"):
+    '''
+    Estimates the peak memory footprint of an elicitation engine; the estimates follow the
+    temporaries created by the individual implementations and are deliberately on the safe side
+    (the few fixed-size block buffers of the out-of-core engines, see hyptrails.pipeline, are not included)
+    :param engine: one of ENGINES
+    :param shape: shape of the hypothesis matrix
+    :param nnz: number of stored elements of the hypothesis matrix
+    :param dtype: dtype of the hypothesis matrix
+    :param mode: "integers" or "reals"
+    :return: number of bytes
+    '''
+    n, m = shape
+    matrix = csr_bytes(n, nnz, dtype)
+    # normalized/scaled copies are always float64
+    work = csr_bytes(n, nnz, np.float64)
+
+    if engine == "distr_chips":
+        if mode == "reals":
+            return matrix + 2 * work
+        # scaled matrix, floored, rest, the updated floored matrix, argpartition and nonzero() indices
+        return matrix + 4 * work + 3 * nnz * 8
+    if engine == "distr_chips_row":
+        if mode == "reals":
+            return matrix + 2 * work
+        # row slices, per-row results and the COO intermediate of vstack
+        return matrix + 3 * work + 3 * nnz * 8
+    if engine == "distr_chips_hdf5_sparse":
+        # float32 remainders, indices copy, argpartition result, indptr and row sums
+        return nnz * (4 + np.dtype(index_dtype(nnz)).itemsize + 8) + (n + 1) * 16
+    if engine == "distr_chips_hdf5":
+        # floored and remainder coordinate lists (int64 rows and columns), their csr conversions
+        # and the nonzero() indices and argpartition result of the remainders
+        return nnz * (2 * 16 + 12 + 24) + 2 * work
+
+    raise Exception, "Unknown engine '%s'!" % engine
+
+def hdf5_describe(file, shape=None):
+    '''
+    Shape, nnz, dtype and storage layout of a hypothesis matrix stored in an hdf5 file
+    :param file: hdf5 filename
+    :param shape: shape of the matrix, only used for sparse files without statistics; hypothesis
+                  matrices are assumed to be square (states x states) if not given
+    :return: tuple (shape, nnz, dtype, sparse)
+    '''
+    import tables as tb
+    from hyptrails.hdf5 import hdf5_stats
+
+    h5 = tb.open_file(file, "r")
+    stats = hdf5_stats(h5)
+    data = h5.root.data
+    dtype = data.dtype
+
+    if 'indptr' in h5.root:
+        sparse = True
+        nnz = data.shape[0]
+        if stats is not None and stats['shape'] is not None:
+            shape = stats['shape']
+        elif shape is None:
+            n = h5.root.indptr.shape[0] - 1
+            shape = (n, n)
+    else:
+        sparse = False
+        shape = data.shape
+        if stats is not None:
+            nnz = stats['nnz']
+        else:
+            nnz = shape[0] * shape[1]
+
+    h5.close()
+
+    return shape, nnz, dtype, sparse
+
+def hdf5_has_stats(file):
+    '''
+    Checks whether statistics (see hyptrails.hdf5.hdf5_stats) are stored in an hdf5 file
+    :param file: hdf5 filename
+    :return: True or False
+    '''
+    import tables as tb
+    from hyptrails.hdf5 import hdf5_stats
+
+    h5 = tb.open_file(file, "r")
+    has_stats = hdf5_stats(h5) is not None
+    h5.close()
+
+    return has_stats
+
+def hdf5_matrix_sum(file):
+    '''
+    Sum of a (dense or sparse) hdf5 matrix; read from its statistics if available, otherwise
+    computed in one pass (see hyptrails.hdf5.hdf5_scan_stats) without modifying the file
+    :param file: hdf5 filename
+    :return: matrix sum
+    '''
+    import tables as tb
+    from hyptrails.hdf5 import hdf5_stats, hdf5_scan_stats
+
+    h5 = tb.open_file(file, "r")
+    stats = hdf5_stats(h5)
+    if stats is not None:
+        matrix_sum = stats['matrix_sum']
+    else:
+        matrix_sum = hdf5_scan_stats(h5)[0].sum()
+    h5.close()
+
+    return matrix_sum
+
+def hdf5_load(file, shape=None):
+    '''
+    Loads a (dense or sparse) hdf5 matrix as csr_matrix
+    :param file: hdf5 filename
+    :param shape: shape of the matrix, only necessary for sparse files without statistics
+    :return: csr_matrix
+    '''
+    import tables as tb
+    from scipy.sparse import csr_matrix
+
+    h5 = tb.open_file(file, "r")
+    if 'indptr' in h5.root:
+        matrix = csr_matrix((h5.root.data[:], h5.root.indices[:], h5.root.indptr[:]), shape=shape)
+    else:
+        matrix = csr_matrix(h5.root.data[:])
+    h5.close()
+
+    return matrix
+
+def elicit(matrix, chips, row_based=False, mode="integers", norm=True, memory_budget=None, out_name=None,
+           n_jobs=-1, shape=None):
+    '''
+    Trial roulette method for eliciting Dirichlet priors from expressed hypothesis matrix that automatically
+    chooses the fastest implementation (engine) whose estimated peak memory footprint fits the memory budget.
+    In-memory engines (distr_chips, distr_chips_row) are preferred; if they do not fit, the whole-matrix
+    "integers" elicitation falls back to distr_chips_hdf5_sparse (in-memory matrices are spilled to a temporary
+    hdf5 file for that) or distr_chips_hdf5 for densely stored files.
+    :param matrix: csr_matrix A_k expressing theory H_k, or hdf5 filename where it is stored
+    :param chips: number of chips C to distribute (per row if row_based)
+    :param row_based: set True for row-based distribution (see distr_chips_row)
+    :param mode: "integers" or "reals" (see distr_chips)
+    :param norm: set False if matrix does not need to be normalized; for hdf5 files without statistics
+                 the matrix sum is computed in an extra pass before out-of-core normalization (the file
+                 itself is never modified)
+    :param memory_budget: number of bytes the elicitation may use; defaults to the available physical memory
+    :param out_name: filename of the result if an out-of-core engine is chosen; a temporary file is created
+                     if not given
+    :param n_jobs: number of jobs for distr_chips_row
+    :param shape: shape of the matrix, only used for sparsely stored hdf5 files without statistics; such
+                  matrices are assumed to be square (states x states) if not given
+    :return: tuple (prior, engine); prior is a csr_matrix for in-memory engines and the filename of the
+             hdf5 result for out-of-core engines
+    '''
+
+    if mode not in ['integers', 'reals']:
+        raise Exception, "Mode needs to be 'integers' or 'reals'!"
+
+    if memory_budget is None:
+        memory_budget = available_memory()
+    if memory_budget is None:
+        memory_budget = float("inf")
+
+    is_file = isinstance(matrix, basestring)
+    if is_file:
+        shape, nnz, dtype, sparse = hdf5_describe(matrix, shape)
+    else:
+        shape, nnz, dtype, sparse = matrix.shape, matrix.nnz, matrix.dtype, True
+
+    in_memory = "distr_chips_row" if row_based else "distr_chips"
+    candidates = [in_memory]
+    if not row_based and mode == "integers":
+        candidates.append("distr_chips_hdf5_sparse" if sparse else "distr_chips_hdf5")
+
+    engine = None
+    for e in candidates:
+        footprint = estimate_footprint(e, shape, nnz, dtype, mode)
+        if is_file and e == in_memory:
+            # the matrix needs to be loaded first; dense files are loaded via a dense copy
+            if not sparse:
+                footprint += shape[0] * shape[1] * np.dtype(dtype).itemsize
+        elif not is_file and e != in_memory:
+            # the caller's matrix stays in memory while we work on the spilled copy
+            footprint += csr_bytes(shape[0], nnz, dtype)
+        if footprint <= memory_budget:
+            engine = e
+            break
+
+    if engine is None:
+        msg = "No elicitation engine fits into the memory budget of %d bytes (row_based=%s, mode=%s)!"
+        raise Exception, msg % (memory_budget, row_based, mode)
+
+    if engine == in_memory:
+        if is_file:
+            matrix = hdf5_load(matrix, shape)
+        if row_based:
+            return distr_chips_row(matrix, chips, n_jobs=n_jobs, norm=norm, mode=mode), engine
+        return distr_chips(matrix, chips, norm=norm, mode=mode), engine
+
+    from hyptrails import hdf5
+
+    if out_name is None:
+        fd, out_name = tempfile.mkstemp(suffix=".hdf5")
+        os.close(fd)
+
+    matrix_sum_final = None
+    if is_file and norm and not hdf5_has_stats(matrix):
+        matrix_sum_final = hdf5_matrix_sum(matrix)
+
+    if engine == "distr_chips_hdf5":
+        hdf5.distr_chips_hdf5(matrix, chips, matrix_sum_final=matrix_sum_final, out_name=out_name, norm=norm)
+        return out_name, engine
+
+    spilled = None
+    if not is_file:
+        fd, spilled = tempfile.mkstemp(suffix=".hdf5", dir=os.path.dirname(os.path.abspath(out_name)))
+        os.close(fd)
+        hdf5.hdf5_save(matrix, spilled)
+        matrix = spilled
+
+    try:
+        hdf5.distr_chips_hdf5_sparse(matrix, chips, matrix_sum_final=matrix_sum_final, out_name=out_name, norm=norm)
+    finally:
+        if spilled is not None:
+            os.remove(spilled)
+
+    return out_name, engine
@@ -0,0 +1,250 @@
+from __future__ import division
+
+__author__ = 'psinger'
+
+# Marginal likelihood (evidence) of first-order Markov chain models with Dirichlet priors,
+# computed directly on sparse transition count and prior matrices. This covers the
+# evidence calculation of pathtools.markovchain.MarkovChain (modus="bayes", reset=False)
+# for many trail cohorts (groups) and hypotheses at once. Priors stored in hdf5 files (e.g., by
+# distr_chips_hdf5_sparse) are streamed block by block; PyTables is only imported for those.
+
+import numpy as np
+from scipy.sparse import coo_matrix
+from scipy.special import gammaln
+
+def grouped_transition_counts(trails, groups, vocab, state_count=None):
+    '''
+    Builds first-order transition counts for trails tagged with a group id in a single pass.
+    The counts of all groups are stacked into one csr_matrix; group g (in order of first
+    appearance) occupies rows g*state_count to (g+1)*state_count.
+    :param trails: list of trails (sequences of states)
+    :param groups: group id of each trail
+    :param vocab: dictionary mapping states to row/column indices
+    :param state_count: number of states; defaults to the largest index in vocab + 1
+    :return: tuple (counts, group_ids) with the stacked csr_matrix and the list of group ids
+    '''
+
+    if state_count is None:
+        state_count = max(vocab.itervalues()) + 1
+
+    group_index = {}
+    rows = []
+    cols = []
+    for trail, group in zip(trails, groups):
+        g = group_index.setdefault(group, len(group_index))
+        if len(trail) < 2:
+            continue
+        idx = np.fromiter((vocab[s] for s in trail), dtype=np.int64, count=len(trail))
+        rows.append(idx[:-1] + g * state_count)
+        cols.append(idx[1:])
+
+    group_ids = sorted(group_index, key=group_index.get)
+    shape = (len(group_ids) * state_count, state_count)
+
+    if len(rows) == 0:
+        return coo_matrix(shape, dtype=np.float64).tocsr(), group_ids
+
+    rows = np.concatenate(rows)
+    cols = np.concatenate(cols)
+    # duplicates are summed up when converting to csr
+    counts = coo_matrix((np.ones(rows.shape[0], dtype=np.float64), (rows, cols)), shape=shape).tocsr()
+
+    return counts, group_ids
+
+def transition_counts(trails, vocab, state_count=None):
+    '''
+    Builds first-order transition counts of trails
+    :param trails: list of trails (sequences of states)
+    :param vocab: dictionary mapping states to row/column indices
+    :param state_count: number of states; defaults to the largest index in vocab + 1
+    :return: csr_matrix with transition counts
+    '''
+
+    counts, _ = grouped_transition_counts(trails, [0] * len(trails), vocab, state_count)
+    return counts
+
+def grouped_evidence(counts, priors, flat_prior=1.):
+    '''
+    Log marginal likelihood (evidence) of each group for several elicited priors.
+    The count-side preparation is done once; for each prior only the prior values at the observed
+    transitions are gathered (the prior matrices are shared by all groups and never copied) and the
+    evidence is summed per group with segmented reductions.
+    :param counts: stacked csr_matrix with transition counts (see grouped_transition_counts)
+    :param priors: dictionary mapping a key (e.g., (hypothesis, k)) to an elicited prior (csr_matrix of
+                   shape state_count x state_count, e.g., from distr_chips_row, or the compact form
+                   (table, row_pattern) from distr_chips_row(..., dedupe=True)); None means no informative prior
+    :param flat_prior: pseudo count added to each hyperparameter for ensuring proper priors
+    :return: dictionary mapping each key of priors to an array with the evidence of each group
+    '''
+
+    n = counts.shape[1]
+    if counts.shape[0] % n != 0:
+        raise Exception, "The number of rows of counts needs to be a multiple of the number of states!"
+    n_groups = counts.shape[0] // n
+
+    counts = counts.tocsr()
+    row_nnz = np.diff(counts.indptr)
+    entry_rows = np.repeat(np.arange(counts.shape[0]), row_nnz)
+    entry_states = entry_rows % n
+    entry_groups = entry_rows // n
+    entry_cols = counts.indices
+    entry_counts = counts.data.astype(np.float64)
+
+    row_totals = np.asarray(counts.sum(axis=1), dtype=np.float64).ravel()
+    active_rows = np.where(row_totals > 0)[0]
+    active_states = active_rows % n
+    active_groups = active_rows // n
+    active_totals = row_totals[active_rows]
+
+    ret = {}
+    for key, prior in priors.iteritems():
+        if prior is None:
+            prior_row_sums = np.zeros(active_states.shape[0])
+            prior_values = np.zeros(entry_counts.shape[0])
+        elif isinstance(prior, tuple):
+            # compact prior (see hyptrails.patterns); lookups go through the pattern table
+            table, row_pattern = prior
+            if table.shape[1] != n or row_pattern.shape[0] != n:
+                raise Exception, "Prior for %s needs to cover %d states!" % (key, n)
+            table = table.tocsr()
+            prior_row_sums = np.asarray(table.sum(axis=1), dtype=np.float64).ravel()[row_pattern[active_states]]
+            if entry_counts.shape[0] > 0:
+                prior_values = np.asarray(table[row_pattern[entry_states], entry_cols], dtype=np.float64).ravel()
+            else:
+                prior_values = np.zeros(0)
+        else:
+            if prior.shape != (n, n):
+                raise Exception, "Prior for %s needs to be of shape %s!" % (key, (n, n))
+            prior_row_sums = np.asarray(prior.sum(axis=1), dtype=np.float64).ravel()[active_states]
+            if entry_counts.shape[0] > 0:
+                prior_values = np.asarray(prior[entry_states, entry_cols], dtype=np.float64).ravel()
+            else:
+                prior_values = np.zeros(0)
+
+        alpha = prior_values + flat_prior
+        entry_terms = gammaln(alpha + entry_counts) - gammaln(alpha)
+
+        alpha_sums = prior_row_sums + flat_prior * n
+        row_terms = gammaln(alpha_sums) - gammaln(alpha_sums + active_totals)
+
+        ret[key] = np.bincount(entry_groups, weights=entry_terms, minlength=n_groups) + \
+                   np.bincount(active_groups, weights=row_terms, minlength=n_groups)
+
+    return ret
+
+def marginal_likelihood(counts, prior, flat_prior=1.):
+    '''
+    Log marginal likelihood (evidence) of transition counts given an elicited prior
+    :param counts: csr_matrix with transition counts (see transition_counts)
+    :param prior: elicited prior (csr_matrix or compact (table, row_pattern)), None means no informative prior
+    :param flat_prior: pseudo count added to each hyperparameter for ensuring proper priors
+    :return: evidence
+    '''
+
+    return grouped_evidence(counts, {None: prior}, flat_prior)[None][0]
+
+def hdf5_grouped_evidence(counts, file, flat_prior=1., block_size=1000000):
+    '''
+    Log marginal likelihood (evidence) of each group for an elicited prior stored in an hdf5 file
+    The prior is read sequentially in indptr-aligned row blocks of about block_size elements and each
+    block is joined with the count rows of the same states, so that only one block is held in memory.
+    :param counts: stacked csr_matrix with transition counts (see grouped_transition_counts)
+    :param file: hdf5 filename of a sparsely stored prior (data, indices, indptr fields; e.g., from
+                 distr_chips_hdf5_sparse)
+    :param flat_prior: pseudo count added to each hyperparameter for ensuring proper priors
+    :param block_size: (approximate) number of prior elements read at once
+    :return: array with the evidence of each group
+    '''
+    import tables as tb
+    from hyptrails.hdf5 import hdf5_stats
+    from hyptrails.pipeline import row_blocks
+
+    n = counts.shape[1]
+    if counts.shape[0] % n != 0:
+        raise Exception, "The number of rows of counts needs to be a multiple of the number of states!"
+    n_groups = counts.shape[0] // n
+
+    # count entries ordered by state, so that each block of prior rows joins a contiguous segment
+    counts = counts.tocoo()
+    keep = counts.data != 0
+    order = np.argsort(counts.row[keep] % n, kind='mergesort')
+    entry_states = (counts.row[keep] % n)[order].astype(np.int64)
+    entry_groups = (counts.row[keep] // n)[order]
+    entry_cols = counts.col[keep][order].astype(np.int64)
+    entry_counts = counts.data[keep][order].astype(np.float64)
+
+    row_totals = np.bincount(counts.row[keep], weights=counts.data[keep].astype(np.float64),
+                             minlength=counts.shape[0])
+    active_rows = np.where(row_totals > 0)[0]
+    active_states = active_rows % n
+    order = np.argsort(active_states, kind='mergesort')
+    active_states = active_states[order]
+    active_groups = (active_rows // n)[order]
+    active_totals = row_totals[active_rows][order]
+
+    h5 = tb.open_file(file, "r")
+    data = h5.root.data
+    indices = h5.root.indices
+    indptr = h5.root.indptr[:]
+
+    if indptr.shape[0] - 1 != n:
+        h5.close()
+        raise Exception, "Prior in %s needs to cover %d states!" % (file, n)
+
+    stats = hdf5_stats(h5)
+    row_sums = stats['row_sums'][:] if stats is not None else None
+
+    ret = np.zeros(n_groups)
+    n_blocks = max(int(np.ceil(indptr[-1] / block_size)), 1)
+    for start, end in row_blocks(indptr, n_blocks):
+        e_lo, e_hi = np.searchsorted(entry_states, [start, end])
+        a_lo, a_hi = np.searchsorted(active_states, [start, end])
+        if a_hi == a_lo:
+            # no observed transitions in these rows
+            continue
+
+        lo, hi = int(indptr[start]), int(indptr[end])
+        block = data[lo:hi].astype(np.float64)
+        block_rows = np.repeat(np.arange(start, end, dtype=np.int64), np.diff(indptr[start:end+1]))
+        keys = block_rows * n + indices[lo:hi]
+
+        if row_sums is not None:
+            block_sums = row_sums[start:end]
+        else:
+            block_sums = np.bincount(block_rows - start, weights=block, minlength=end - start)
+
+        # prior values at the observed transitions (zero if not stored)
+        prior_values = np.zeros(e_hi - e_lo)
+        if hi > lo and e_hi > e_lo:
+            key_order = np.argsort(keys, kind='mergesort')
+            keys = keys[key_order]
+            entry_keys = entry_states[e_lo:e_hi] * n + entry_cols[e_lo:e_hi]
+            pos = np.minimum(np.searchsorted(keys, entry_keys), keys.shape[0] - 1)
+            found = keys[pos] == entry_keys
+            prior_values[found] = block[key_order[pos[found]]]
+
+        alpha = prior_values + flat_prior
+        entry_terms = gammaln(alpha + entry_counts[e_lo:e_hi]) - gammaln(alpha)
+
+        alpha_sums = block_sums[active_states[a_lo:a_hi] - start] + flat_prior * n
+        row_terms = gammaln(alpha_sums) - gammaln(alpha_sums + active_totals[a_lo:a_hi])
+
+        ret += np.bincount(entry_groups[e_lo:e_hi], weights=entry_terms, minlength=n_groups) + \
+               np.bincount(active_groups[a_lo:a_hi], weights=row_terms, minlength=n_groups)
+
+    h5.close()
+
+    return ret
+
+def hdf5_marginal_likelihood(counts, file, flat_prior=1., block_size=1000000):
+    '''
+    Log marginal likelihood (evidence) of transition counts given an elicited prior stored in an hdf5 file
+    (see hdf5_grouped_evidence)
+    :param counts: csr_matrix with transition counts (see transition_counts)
+    :param file: hdf5 filename of a sparsely stored prior
+    :param flat_prior: pseudo count added to each hyperparameter for ensuring proper priors
+    :param block_size: (approximate) number of prior elements read at once
+    :return: evidence
+    '''
+
+    return hdf5_grouped_evidence(counts, file, flat_prior, block_size)[0]
@@ -0,0 +1,671 @@
+from __future__ import division
+
+__author__ = 'psinger'
+
+# PyTables is only imported here so that the in-memory core (trial_roulette) and
+# the joblib workers it spawns do not pay for HDF5 initialization
+
+import os
+import tables as tb
+import numpy as np
+from scipy.sparse import csr_matrix
+from hyptrails.trial_roulette import index_dtype, chips_dtype
+from hyptrails.pipeline import hdf5_lock, block_rows, read_blocks, BlockWriter
+
+#####HDF5 Methods#####
+
+# Note that the following HDF5 methods only support the "integers" mode at the moment.
+# Furthermore, no dedicated row-based methods are available
+# Preferably, the sparse methods in trial_roulette should be utilized as they offer more functionality
+# and as they are more rigorously tested
+
+def hdf5_save(matrix, filename, dtype=None):
+    '''
+    Helper function for storing scipy matrices as PyTables HDF5 matrices
+    see http://www.philippsinger.info/?p=464 for further information
+    indices and indptr are stored as int32, or as int64 if the matrix exceeds 2^31 nonzeros or columns
+    Statistics (see hdf5_stats) are stored alongside so that elicitation needs no extra pass
+    :param matrix: matrix to store
+    :param filename: filename for storage
+    :param dtype: dtype of the stored data; defaults to the dtype of the matrix
+    :return: True
+    '''
+
+    #print matrix.shape
+
+    if dtype is None:
+        dtype = matrix.dtype
+
+    atom = tb.Atom.from_dtype(np.dtype(dtype))
+    index_atom = tb.Atom.from_dtype(index_dtype(max(matrix.nnz, matrix.shape[1])))
+
+    f = tb.open_file(filename, 'w')
+
+    #print "saving data"
+    filters = tb.Filters(complevel=5, complib='blosc')
+    out = f.create_carray(f.root, 'data', atom, shape=matrix.data.shape, filters=filters)
+    out[:] = matrix.data
+
+    #print "saving indices"
+    out = f.create_carray(f.root, 'indices', index_atom, shape=matrix.indices.shape, filters=filters)
+    out[:] = matrix.indices
+
+    #print "saving indptr"
+    out = f.create_carray(f.root, 'indptr', index_atom, shape=matrix.indptr.shape, filters=filters)
+    out[:] = matrix.indptr
+
+    hdf5_store_stats(f, np.asarray(matrix.sum(axis=1), dtype=np.float64).ravel(), np.diff(matrix.indptr),
+                     shape=matrix.shape, dtype=dtype)
+
+    #print "saving done"
+
+    f.close()
+
+    return
+
+def hdf5_store_stats(f, row_sums, row_nnz, shape=None, dtype=None):
+    '''
+    Stores statistics of a matrix in an open PyTables file; total sum and nnz (plus shape and dtype
+    if given) as attributes of the root node and per-row sums and nnz as side arrays
+    :param f: PyTables file opened for writing
+    :param row_sums: array with the sum of each row
+    :param row_nnz: array with the number of stored elements of each row
+    :param shape: shape of the matrix
+    :param dtype: dtype of the matrix
+    :return: True
+    '''
+
+    for name in ('row_sums', 'row_nnz'):
+        if name in f.root:
+            f.remove_node(f.root, name)
+
+    filters = tb.Filters(complevel=5, complib='blosc')
+    out = f.create_carray(f.root, 'row_sums', tb.Float64Atom(), shape=row_sums.shape, filters=filters)
+    out[:] = row_sums
+
+    nnz = int(row_nnz.sum())
+    out = f.create_carray(f.root, 'row_nnz', tb.Atom.from_dtype(index_dtype(nnz)), shape=row_nnz.shape,
+                          filters=filters)
+    out[:] = row_nnz
+
+    attrs = f.root._v_attrs
+    attrs.matrix_sum = float(row_sums.sum())
+    attrs.nnz = nnz
+    if shape is not None:
+        attrs.shape = tuple(int(x) for x in shape)
+    if dtype is not None:
+        attrs.dtype = np.dtype(dtype).str
+
+    return
+
+def hdf5_stats(h5):
+    '''
+    Reads the statistics stored by hdf5_store_stats
+    :param h5: open PyTables file
+    :return: dict with matrix_sum, nnz, shape, dtype and the row_sums and row_nnz nodes
+             (not loaded into memory); None if the file has no statistics
+    '''
+
+    attrs = h5.root._v_attrs
+    if 'matrix_sum' not in attrs._v_attrnames:
+        return None
+
+    stats = {'matrix_sum': attrs.matrix_sum, 'nnz': attrs.nnz, 'shape': None, 'dtype': None,
+             'row_sums': h5.root.row_sums, 'row_nnz': h5.root.row_nnz}
+    if 'shape' in attrs._v_attrnames:
+        stats['shape'] = tuple(attrs.shape)
+    if 'dtype' in attrs._v_attrnames:
+        stats['dtype'] = np.dtype(attrs.dtype)
+
+    return stats
+
+def hdf5_scan_stats(h5):
+    '''
+    Computes the statistics of a dense (data) or sparse (data, indices, indptr) hdf5 matrix without
+    storing them; needs one pass over the data
+    :param h5: open PyTables file
+    :return: tuple (row_sums, row_nnz, shape, dtype); shape is None for sparse matrices
+    '''
+
+    data = h5.root.data
+    l = data.shape[0]
+
+    if 'indptr' in h5.root:
+        indptr = h5.root.indptr[:]
+        n = indptr.shape[0] - 1
+        row_sums = np.zeros(n, dtype=np.float64)
+        for i, block in read_blocks(data, 0, l, block_rows(data)):
+            add_row_sums(row_sums, indptr, i, block.astype(np.float64))
+        return row_sums, np.diff(indptr), None, data.dtype
+
+    row_sums = np.empty(l, dtype=np.float64)
+    row_nnz = np.empty(l, dtype=np.int64)
+    for i, rows in read_blocks(data, 0, l, block_rows(data)):
+        row_sums[i:i+rows.shape[0]] = rows.sum(axis=1, dtype=np.float64)
+        row_nnz[i:i+rows.shape[0]] = np.count_nonzero(rows, axis=1)
+    return row_sums, row_nnz, data.shape, data.dtype
+
+def hdf5_compute_stats(file):
+    '''
+    Computes and stores the statistics of an existing dense (data) or sparse (data, indices, indptr)
+    hdf5 matrix that has been written without them; needs one pass over the data
+    :param file: hdf5 filename
+    :return: True
+    '''
+
+    f = tb.open_file(file, "a")
+
+    row_sums, row_nnz, shape, dtype = hdf5_scan_stats(f)
+    hdf5_store_stats(f, row_sums, row_nnz, shape=shape, dtype=dtype)
+
+    f.close()
+
+    return
+
+def add_row_sums(row_sums, indptr, start, block):
+    '''
+    Adds a contiguous block of CSR data values to the sums of the rows they belong to
+    :param row_sums: array of row sums to update in place
+    :param indptr: CSR indptr array (in memory)
+    :param start: position of the first block element in the data array
+    :param block: block of data values
+    :return: True
+    '''
+
+    if len(block) == 0:
+        return
+    row_idx = np.searchsorted(indptr, np.arange(start, start + len(block)), side='right') - 1
+    # row_idx is sorted, so each row is a contiguous segment of the block
+    row_idx, first = np.unique(row_idx, return_index=True)
+    row_sums[row_idx] += np.add.reduceat(block, first)
+
+    return
+
+def check_params(stored, params, out_name, what):
+    '''
+    Compares the parameters an output file was written with to the parameters of the current run
+    :param stored: dictionary with the stored parameters (None if there are none)
+    :param params: dictionary with the parameters of the current run
+    :param out_name: filename of the output file
+    :param what: description of what is checked (for the error message)
+    :return: error message; None if the parameters match
+    '''
+
+    if stored is None:
+        return "%s in %s was not written by a resumable run!" % (what, out_name)
+    for key, value in sorted(params.iteritems()):
+        if stored.get(key) != value:
+            return "%s in %s was written with %s=%s, not %s!" % (what, out_name, key, stored.get(key), value)
+
+    return None
+
+def checkpoint_open(out_name, resume, params):
+    '''
+    Opens the output file of a checkpointed elicitation run
+    The checkpoint lives in the /checkpoint group of the output file and records the parameters of the run,
+    so that a checkpoint is only resumed by the same run. Finished outputs record them as well (see
+    store_params); resuming a finished output of the same run does nothing.
+    :param out_name: filename of the output file
+    :param resume: set True to continue from the checkpoint of an interrupted run (if there is one)
+    :param params: dictionary with the parameters of the run
+    :return: tuple (f, checkpoint); f is the open output file and checkpoint the checkpoint group;
+             f is None if resume is set and the output file is already complete
+    '''
+
+    if resume and os.path.exists(out_name):
+        f = tb.open_file(out_name, 'a')
+        if 'checkpoint' in f.root:
+            checkpoint = f.root.checkpoint
+            attrs = checkpoint._v_attrs
+            msg = check_params(attrs.params if 'params' in attrs else None, params, out_name, "Checkpoint")
+            if msg is not None:
+                f.close()
+                raise Exception, msg
+            return f, checkpoint
+        if hdf5_stats(f) is not None:
+            attrs = f.root._v_attrs
+            msg = check_params(attrs.params if 'params' in attrs else None, params, out_name, "Output")
+            f.close()
+            if msg is not None:
+                raise Exception, msg
+            return None, None
+        # neither a checkpoint nor a finished output; start over
+        f.close()
+
+    f = tb.open_file(out_name, 'w')
+    checkpoint = f.create_group(f.root, 'checkpoint')
+    checkpoint._v_attrs.params = params
+
+    return f, checkpoint
+
+def store_params(f, params):
+    '''
+    Records the parameters of an elicitation run in its finished output (see checkpoint_open)
+    :param f: open PyTables output file
+    :param params: dictionary with the parameters of the run
+    :return: True
+    '''
+
+    f.root._v_attrs.params = params
+
+    return
+
+def distr_chips_hdf5(file, chips, matrix_sum_final=None, out_name=None, norm=True, checkpoint_every=None,
+                     resume=False, block_size=None, progress=None):
+    '''
+    HDF5 (PyTables) version of the trial roulette method for eliciting Dirichlet priors from
+    expressed hypothesis matrix.
+    Note that only the informative part is done here.
+    This works for densely stored hdf5 matrices (i.e., single data matrix).
+    :param file: hdf5 filename where hypothesis matrix A is stored
+    :param chips: number of chips C to distribute
+    :param matrix_sum_final: the final sum of the input matrix; read from the statistics stored
+                             in the file (see hdf5_stats) if not given
+    :param out_name: filename of new file
+    :param norm: set False if matrix does not need to be normalized
+    :param checkpoint_every: number of blocks after which the progress is persisted into out_name;
+                             None disables checkpoints (unless resume is set)
+    :param resume: set True to continue an interrupted run from its last checkpoint in out_name;
+                   the result is identical to an uninterrupted run
+    :param block_size: number of rows (elements for sparse matrices) processed at once; derived from the
+                       chunkshape of the stored matrix if not given (see hyptrails.pipeline.block_rows)
+    :param progress: function called as progress(phase, cursor) after each block ("scan"), before the
+                     remainders are handed out ("increment") and before the result is written ("finalize");
+                     cursor is the number of rows (elements) done. An exception raised by it interrupts the
+                     run like a crash; with checkpoints the run can be resumed afterwards
+    :return: True
+    '''
+
+    if out_name is None:
+        raise Exception, "out_name needs to be provided!"
+
+    h5 = tb.open_file(file, "r")
+    f = None
+    try:
+        stats = hdf5_stats(h5)
+        if norm and matrix_sum_final is None:
+            if stats is None:
+                msg = "No statistics stored in file; provide matrix_sum_final or call hdf5_compute_stats first!"
+                raise Exception, msg
+            matrix_sum_final = stats['matrix_sum']
+
+        matrix = h5.root.data
+
+        #print matrix[:]
+
+        l = matrix.shape[0]
+        k = matrix.shape[1]
+
+        #print matrix[0]
+
+        bl = block_size if block_size is not None else block_rows(matrix)
+
+        # no element can receive more than all chips, so this dtype cannot overflow
+        dtype = chips_dtype(chips)
+
+        # nonzero floored values and remainders are collected as coordinates (in row-major order)
+        names = ['floored_rows', 'floored_cols', 'floored', 'rest_rows', 'rest_cols', 'rest']
+        dtypes = [np.int64, np.int64, dtype, np.int64, np.int64, np.float32]
+        parts = dict((name, []) for name in names)
+
+        params = {'chips': float(chips), 'matrix_sum_final': float(matrix_sum_final or 0.), 'norm': bool(norm),
+                  'rows': int(l), 'cols': int(k)}
+
+        start = 0
+        if checkpoint_every is not None or resume:
+            if checkpoint_every is None:
+                checkpoint_every = 100
+            f, checkpoint = checkpoint_open(out_name, resume, params)
+            if f is None:
+                return
+            for name, d in zip(names, dtypes):
+                if name not in checkpoint:
+                    f.create_earray(checkpoint, name, tb.Atom.from_dtype(np.dtype(d)), shape=(0,),
+                                    filters=tb.Filters(complevel=5, complib='blosc'))
+                node = checkpoint._f_get_child(name)
+                # anything appended after the last consistent checkpoint is discarded
+                node.truncate(checkpoint._v_attrs.state[name] if 'state' in checkpoint._v_attrs else 0)
+                parts[name].append(node[:])
+            if 'state' in checkpoint._v_attrs:
+                start = checkpoint._v_attrs.state['cursor']
+            # number of parts that are already stored in the checkpoint
+            flushed = 1
+
+        matrix_sum = 0.
+        nnz_sum = 0.
+        flushme = 0
+        # the next blocks are read in the background while the current one is processed
+        blocks = read_blocks(matrix, start, l, bl)
+        try:
+            for i, block in blocks:
+                #print i
+                if norm:
+                    rows = block.astype(np.float64) / matrix_sum_final
+                else:
+                    rows = block.astype(np.float64)
+                matrix_sum += rows.sum()
+                rows = rows * chips
+                floor_tmp = np.floor(rows)
+                r, c = np.nonzero(floor_tmp)
+                parts['floored_rows'].append(r + i)
+                parts['floored_cols'].append(c)
+                parts['floored'].append(floor_tmp[r, c].astype(dtype))
+                rest_tmp = (rows - floor_tmp).astype(np.float32)
+                r, c = np.nonzero(rest_tmp)
+                parts['rest_rows'].append(r + i)
+                parts['rest_cols'].append(c)
+                parts['rest'].append(rest_tmp[r, c])
+
+                flushme += 1
+                if f is not None and (flushme % checkpoint_every == 0 or i + bl >= l):
+                    # append everything since the last checkpoint, then move the cursor (a single attribute,
+                    # so that the checkpoint always is consistent)
+                    state = {'cursor': min(i + bl, l)}
+                    with hdf5_lock:
+                        for name in names:
+                            node = checkpoint._f_get_child(name)
+                            node.append(np.concatenate(parts[name][flushed:]))
+                            state[name] = node.nrows
+                        checkpoint._v_attrs.state = state
+                        f.flush()
+                    flushed = len(parts['rest'])
+
+                if progress is not None:
+                    progress("scan", min(i + bl, l))
+
+                #print (time.time()-t0) / 60.
+        finally:
+            blocks.close()
+
+        #print "looping done"
+
+        for name, d in zip(names, dtypes):
+            parts[name] = np.concatenate(parts[name]) if len(parts[name]) > 0 else np.zeros(0, dtype=d)
+
+        floored = csr_matrix((parts['floored'], (parts['floored_rows'], parts['floored_cols'])), shape=(l, k),
+                             dtype=dtype)
+        rest = csr_matrix((parts['rest'], (parts['rest_rows'], parts['rest_cols'])), shape=(l, k), dtype=np.float32)
+        del parts
+
+        #print "matrix sum", matrix_sum
+
+        floored_sum = floored.sum()
+        #print "floored sum", floored_sum
+
+        rest_sum = int(chips - floored_sum)
+
+        if rest_sum > 0.:
+
+            #print "rest sum", rest_sum
+
+            idx = rest.data.argpartition(-rest_sum)[-rest_sum:]
+
+            #print "indexing rest done"
+
+            i, j = rest.nonzero()
+
+            i_idx = i[idx]
+            j_idx = j[idx]
+
+            if len(i_idx) > 0:
+                floored[i_idx, j_idx] += 1
+
+        del rest
+
+        h5.close()
+
+        if progress is not None:
+            progress("finalize", l)
+
+        if f is not None:
+            f.close()
+        # the checkpoint (if any) is only replaced once the final result is completely written
+        hdf5_save(floored, out_name + '.tmp')
+        f = tb.open_file(out_name + '.tmp', 'a')
+        store_params(f, params)
+        f.close()
+        os.rename(out_name + '.tmp', out_name)
+    finally:
+        # files are also closed if the run is interrupted
+        for x in [h5, f]:
+            if x is not None and x.isopen:
+                x.close()
+
+    return
+
+def distr_chips_hdf5_sparse(file, chips, matrix_sum_final=None, out_name=None, norm=True, checkpoint_every=None,
+                            resume=False, block_size=None, progress=None):
+    '''
+    HDF5 (PyTables) version of the trial roulette method for eliciting Dirichlet priors from
+    expressed hypothesis matrix.
+    This version creates a new hdf5 file including the chip distribution.
+    Note that only the informative part is done here.
+    This works for sparsely stored hdf5 matrices.
+    :param file: hdf5 filename where hypothesis matrix A is stored (needs data, indices, indptr fields)
+    :param shape: the shape of the matrix
+    :param chips: number of chips C to distribute
+    :param matrix_sum_final: the final sum of the input matrix; read from the statistics stored
+                             in the file (see hdf5_stats) if not given
+    :param out_name: filename of new file
+    :param norm: set False if matrix does not need to be normalized
+    :param checkpoint_every: number of blocks after which the progress is persisted into out_name;
+                             None disables checkpoints (unless resume is set)
+    :param resume: set True to continue an interrupted run from its last checkpoint in out_name;
+                   the result is identical to an uninterrupted run
+    :param block_size: number of rows (elements for sparse matrices) processed at once; derived from the
+                       chunkshape of the stored matrix if not given (see hyptrails.pipeline.block_rows)
+    :param progress: function called as progress(phase, cursor) after each block ("scan"), before the
+                     remainders are handed out ("increment") and before the result is written ("finalize");
+                     cursor is the number of rows (elements) done. An exception raised by it interrupts the
+                     run like a crash; with checkpoints the run can be resumed afterwards
+    :return: True
+    '''
+
+    if out_name is None:
+        raise Exception, "out_name needs to be provided!"
+
+    h5 = tb.open_file(file, "r")
+    f = None
+    try:
+        stats = hdf5_stats(h5)
+        if norm and matrix_sum_final is None:
+            if stats is None:
+                msg = "No statistics stored in file; provide matrix_sum_final or call hdf5_compute_stats first!"
+                raise Exception, msg
+            matrix_sum_final = stats['matrix_sum']
+
+        data = h5.root.data
+        indices = h5.root.indices
+        indptr = h5.root.indptr
+
+        l = data.shape[0]
+
+        bl = block_size if block_size is not None else block_rows(data)
+
+        atom = tb.Atom.from_dtype(chips_dtype(chips))
+
+        filters = tb.Filters(complevel=5, complib='blosc')
+
+        params = {'chips': float(chips), 'matrix_sum_final': float(matrix_sum_final or 0.), 'norm': bool(norm),
+                  'nnz': int(l), 'rows': int(indptr.shape[0] - 1)}
+
+        checkpoint = None
+        if checkpoint_every is not None or resume:
+            if checkpoint_every is None:
+                checkpoint_every = 100
+            f, checkpoint = checkpoint_open(out_name, resume, params)
+            if f is None:
+                return
+        else:
+            f = tb.open_file(out_name, 'w')
+
+        #print data.shape
+        rest = np.empty(data.shape, dtype=np.float32)
+
+        ##print rest.shape
+        #sys.exit()
+
+        if checkpoint is None or 'state' not in checkpoint._v_attrs:
+            for name in ['data', 'indices', 'indptr']:
+                if name in f.root:
+                    f.remove_node(f.root, name)
+
+            data_out = f.create_carray(f.root, 'data', atom, shape=data.shape, filters=filters)
+
+            #print "saving indices"
+            indices_out = f.create_carray(f.root, 'indices', indices.atom, shape=indices.shape, filters=filters)
+            indices_out[:] = indices[:]
+
+            #print "saving indptr"
+            indptr_out = f.create_carray(f.root, 'indptr', tb.Atom.from_dtype(index_dtype(l)), shape=indptr.shape,
+                                         filters=filters)
+            indptr = indptr[:]
+            indptr_out[:] = indptr
+
+            # statistics of the output are gathered on the fly
+            row_sums = np.zeros(indptr.shape[0] - 1, dtype=np.float64)
+
+            state = {'cursor': 0, 'floored_sum': 0, 'slot': 0, 'phase': 'scan'}
+            if checkpoint is not None:
+                # remainders and row sums (two slots, so that one of them always is consistent) of the checkpoint
+                f.create_carray(checkpoint, 'rest', tb.Float32Atom(), shape=data.shape, filters=filters)
+                for slot in [0, 1]:
+                    f.create_carray(checkpoint, 'row_sums_%d' % slot, tb.Float64Atom(), shape=row_sums.shape,
+                                    filters=filters)
+                checkpoint._v_attrs.state = state
+                f.flush()
+        else:
+            data_out = f.root.data
+            indptr = indptr[:]
+            state = checkpoint._v_attrs.state
+            row_sums = checkpoint._f_get_child('row_sums_%d' % state['slot'])[:]
+            if state['phase'] == 'scan':
+                rest[:state['cursor']] = checkpoint.rest[:state['cursor']]
+
+        matrix_sum = 0.
+        nnz_sum = 0.
+        flushme = 0
+        floored_sum = state['floored_sum']
+        start = state['cursor'] if state['phase'] == 'scan' else l
+        # the next blocks are read in the background while the current one is processed and
+        # the floored blocks are written in the background as well
+        blocks = read_blocks(data, start, l, bl)
+        writer = BlockWriter()
+        try:
+            for i, block in blocks:
+                #print i
+                if norm:
+                    rows = block.astype(np.float64) / matrix_sum_final
+                else:
+                    rows = block.astype(np.float64)
+                matrix_sum += rows.sum()
+                rows = rows * chips
+                floor_tmp = np.floor(rows)
+                writer.write(data_out, i, floor_tmp)
+                floored_sum += floor_tmp.sum()
+                add_row_sums(row_sums, indptr, i, floor_tmp)
+                rest_tmp = rows - floor_tmp
+                ##print rest_tmp
+                ##print rest[i:min(i+bl, l)]
+                rest[i:min(i+bl, l)] = rest_tmp
+                ##print "nnz floored", floored.nnz
+                ##print "nnz rest", rest.nnz
+
+                flushme += 1
+                if checkpoint is not None and (flushme % checkpoint_every == 0 or i + bl >= l):
+                    # everything before the cursor is final; the row sums go to the unused slot and the
+                    # state (a single attribute) switches over to it
+                    cursor = min(i + bl, l)
+                    writer.wait()
+                    slot = 1 - state['slot']
+                    with hdf5_lock:
+                        checkpoint.rest[state['cursor']:cursor] = rest[state['cursor']:cursor]
+                        checkpoint._f_get_child('row_sums_%d' % slot)[:] = row_sums
+                        f.flush()
+                        state = {'cursor': cursor, 'floored_sum': floored_sum, 'slot': slot, 'phase': 'scan'}
+                        checkpoint._v_attrs.state = state
+                        f.flush()
+
+                if progress is not None:
+                    progress("scan", min(i + bl, l))
+
+                #print (time.time()-t0) / 60.
+        finally:
+            blocks.close()
+            writer.close()
+
+        #print "looping done"
+
+        #floored = floored.tocsr()
+        #rest = rest.tocsr()
+
+        #print "matrix sum", matrix_sum
+
+        #floored_sum = data_out.sum()
+        #print "floored sum", floored_sum
+
+        rest_sum = int(chips - floored_sum)
+
+        if rest_sum > 0.:
+
+        #print "rest sum", rest_sum
+
+            if checkpoint is not None and state['phase'] == 'increment':
+                idx = checkpoint.idx[:]
+                base = checkpoint.base[:]
+            else:
+                idx = rest.argpartition(-rest_sum)[-rest_sum:]
+                base = data_out[idx]
+                if checkpoint is not None:
+                    # the selected elements and their floored values are persisted, so that
+                    # the increment below can simply be repeated after an interruption
+                    for name, values in [('idx', idx), ('base', base)]:
+                        if name in checkpoint:
+                            f.remove_node(checkpoint, name)
+                        f.create_carray(checkpoint, name, obj=values, filters=filters)
+                    f.flush()
+                    state = dict(state, phase='increment')
+                    checkpoint._v_attrs.state = state
+                    f.flush()
+
+            #print "indexing rest done"
+
+            if progress is not None:
+                progress("increment", l)
+
+            data_out[idx] = base + 1
+
+            np.add.at(row_sums, np.searchsorted(indptr, idx, side='right') - 1, 1)
+
+            #print "incrementing index done"
+
+            #floored_sum = data_out.sum()
+            #print "final floored sum", floored_sum
+
+            ##print rest.data.shape, data_out.data.shape
+
+            assert(rest.shape == data_out.shape)
+
+        del rest
+
+        if progress is not None:
+            progress("finalize", l)
+
+        shape = None
+        if stats is not None:
+            shape = stats['shape']
+        hdf5_store_stats(f, row_sums, np.diff(indptr), shape=shape, dtype=atom.dtype)
+        store_params(f, params)
+
+        if checkpoint is not None:
+            # the space of the checkpoint is not reclaimed by HDF5 (use ptrepack for that)
+            f.remove_node(checkpoint, recursive=True)
+
+        #hdf5_save(floored, "file.h5")
+    finally:
+        # files are also closed if the run is interrupted
+        for x in [h5, f]:
+            if x is not None and x.isopen:
+                x.close()
+
+    return
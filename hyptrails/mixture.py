@@ -0,0 +1,236 @@
+from __future__ import division
+
+__author__ = 'psinger'
+
+# Evidence of weighted mixtures of hypotheses, e.g., 0.7 * structural + 0.3 * market.
+# The sparsity patterns of the component hypotheses are aligned once; the mixed row-normalized
+# weights, the row-based (trial) roulette elicitation (see distr_chips_row) and the evidence
+# (see hyptrails.evidence) are then computed for many weight vectors with batched array operations.
+
+import itertools
+import numpy as np
+from scipy.sparse import csr_matrix, coo_matrix
+from scipy.special import gammaln
+
+def weight_grid(n_components, steps=10):
+    '''
+    All weight vectors on a regular grid of the simplex
+    :param n_components: number of component hypotheses
+    :param steps: number of steps between 0 and 1 for each weight
+    :return: array of shape (number of weight vectors, n_components); each row sums to 1
+    '''
+
+    ret = [c for c in itertools.product(xrange(steps + 1), repeat=n_components - 1) if sum(c) <= steps]
+    ret = np.array([list(c) + [steps - sum(c)] for c in ret], dtype=np.float64)
+    return ret / steps
+
+def align_components(components):
+    '''
+    Aligns the sparsity patterns of hypothesis matrices and row-normalizes them
+    :param components: list of csr_matrix hypothesis matrices of the same shape
+    :return: tuple (pattern, values); pattern is a csr_matrix with the union of all nonzero elements
+             (sorted indices) and values an array of shape (len(components), pattern.nnz) with the
+             row-normalized values of each component on the pattern
+    '''
+
+    shape = components[0].shape
+    for c in components:
+        if c.shape != shape:
+            raise Exception, "All component hypotheses need to be of the same shape!"
+
+    pattern = abs(components[0]).tocsr()
+    for c in components[1:]:
+        pattern = pattern + abs(c)
+    pattern = csr_matrix((np.ones(pattern.nnz), pattern.indices, pattern.indptr), shape=shape)
+    pattern.eliminate_zeros()
+    pattern.sort_indices()
+
+    n, m = shape
+    pattern_rows = np.repeat(np.arange(n), np.diff(pattern.indptr))
+    pattern_keys = pattern_rows * m + pattern.indices
+
+    values = np.zeros((len(components), pattern.nnz), dtype=np.float64)
+    for k, c in enumerate(components):
+        c = c.tocoo()
+        keep = c.data != 0
+        rows, cols, data = c.row[keep], c.col[keep], c.data[keep].astype(np.float64)
+        pos = np.searchsorted(pattern_keys, rows.astype(np.int64) * m + cols)
+        np.add.at(values[k], pos, data)
+        sums = np.bincount(pattern_rows, weights=values[k], minlength=n)
+        sums[sums == 0] = 1.
+        values[k] /= sums[pattern_rows]
+
+    return pattern, values
+
+def mixture_prior_values(pattern, values, weights, chips, mode="integers"):
+    '''
+    Row-based (trial) roulette elicitation (see distr_chips_row) for many mixtures at once
+    Ties of the remainders are resolved by column order.
+    :param pattern: aligned sparsity pattern (see align_components)
+    :param values: aligned row-normalized component values (see align_components)
+    :param weights: array of shape (number of mixtures, number of components)
+    :param chips: number of (single row) chips C to distribute
+    :param mode: "integers" or "reals" (see distr_chips_row)
+    :return: tuple (prior_values, zero_rows); prior_values is an array of shape (number of mixtures, pattern.nnz)
+             and zero_rows a boolean array of shape (number of mixtures, number of rows) marking rows without
+             any belief in a mixture
+    '''
+
+    n = pattern.shape[0]
+    indptr = pattern.indptr
+    pattern_rows = np.repeat(np.arange(n), np.diff(indptr))
+    nonempty = np.diff(indptr) > 0
+    starts = indptr[:-1][nonempty]
+
+    mixed = np.dot(np.atleast_2d(weights), values)
+
+    row_sums = np.zeros((mixed.shape[0], n))
+    if pattern.nnz > 0:
+        row_sums[:, nonempty] = np.add.reduceat(mixed, starts, axis=1)
+    zero_rows = row_sums <= 0
+    row_sums[zero_rows] = 1.
+
+    mixed *= chips / row_sums[:, pattern_rows]
+
+    if mode == "reals":
+        return mixed, zero_rows
+
+    floored = np.floor(mixed)
+    rest = np.zeros((mixed.shape[0], n))
+    if pattern.nnz > 0:
+        rest[:, nonempty] = chips - np.add.reduceat(floored, starts, axis=1)
+    rest[zero_rows] = 0
+
+    # rank the remainders within each row (largest first) and hand out one chip to the
+    # rest_sum largest ones; keys sort by row first and by decreasing remainder second
+    keys = pattern_rows * 2. + (1. - (mixed - floored))
+    order = np.argsort(keys, axis=1, kind='mergesort')
+    ranks = np.empty(order.shape, dtype=np.int64)
+    np.put_along_axis(ranks, order, np.broadcast_to(np.arange(pattern.nnz) - indptr[pattern_rows], order.shape),
+                      axis=1)
+
+    floored += ranks < rest[:, pattern_rows]
+
+    return floored, zero_rows
+
+def zero_row_values(cols, m, chips, mode="integers"):
+    '''
+    Pseudo clicks of rows without any belief that receive an equal share of the chips (see distr_chips)
+    In "integers" mode the remaining chips go to the first columns.
+    :param cols: column indices
+    :param m: number of columns
+    :param chips: number of (single row) chips C to distribute
+    :param mode: "integers" or "reals"
+    :return: array of pseudo clicks for cols
+    '''
+
+    if mode == "reals":
+        return np.repeat(chips / m, len(cols))
+    x = np.floor(chips / m)
+    return x + (cols < chips - x * m)
+
+def mixture_priors(components, weights, chips, mode="integers", dist_zero_rows=True):
+    '''
+    Elicited Dirichlet priors of mixtures of hypotheses, sum_c weights[c] * normalized(components[c])
+    :param components: list of csr_matrix hypothesis matrices of the same shape
+    :param weights: array of shape (number of mixtures, number of components)
+    :param chips: number of (single row) chips C to distribute
+    :param mode: "integers" or "reals" (see distr_chips_row)
+    :param dist_zero_rows: if set to False, rows without any belief do not receive chips
+    :return: list of csr_matrix priors, one for each mixture
+    '''
+
+    pattern, values = align_components(components)
+    prior_values, zero_rows = mixture_prior_values(pattern, values, weights, chips, mode)
+
+    n, m = pattern.shape
+    ret = []
+    for k in xrange(prior_values.shape[0]):
+        prior = csr_matrix((prior_values[k], pattern.indices, pattern.indptr), shape=pattern.shape, copy=True)
+        prior.eliminate_zeros()
+        if dist_zero_rows and zero_rows[k].any():
+            # zero rows do not hold any values yet
+            rows = np.where(zero_rows[k])[0]
+            fill = coo_matrix((np.tile(zero_row_values(np.arange(m), m, chips, mode), len(rows)),
+                               (np.repeat(rows, m), np.tile(np.arange(m), len(rows)))), shape=pattern.shape)
+            prior = (prior + fill).tocsr()
+            prior.eliminate_zeros()
+        ret.append(prior)
+
+    return ret
+
+def mixture_evidence(components, weights, counts, chips, mode="integers", flat_prior=1., dist_zero_rows=True,
+                     batch_size=None, memory_budget=1 << 28):
+    '''
+    Evidence of mixtures of hypotheses, sum_c weights[c] * normalized(components[c]), with row-based
+    elicitation (see distr_chips_row). Components are aligned once and the priors are never built as
+    matrices; they are elicited and scored against the counts for batches of weight vectors.
+    :param components: list of csr_matrix hypothesis matrices of the same shape
+    :param weights: array of shape (number of mixtures, number of components), e.g., from weight_grid
+    :param counts: csr_matrix with transition counts (see hyptrails.evidence.transition_counts)
+    :param chips: number of (single row) chips C to distribute
+    :param mode: "integers" or "reals" (see distr_chips_row)
+    :param flat_prior: pseudo count added to each hyperparameter for ensuring proper priors
+    :param dist_zero_rows: if set to False, rows without any belief do not receive chips
+    :param batch_size: number of weight vectors elicited at once; if not given, it is derived from memory_budget
+                       as memory_budget // (48 * size), as a batch holds about six float64 arrays of shape
+                       (batch_size, size), where size is the largest of pattern.nnz, counts.nnz and the number of rows
+    :param memory_budget: number of bytes the arrays of one batch may use if batch_size is not given
+    :return: tuple (best_weights, evidences) with the weight vector of the highest evidence and
+             the evidence of each weight vector
+    '''
+
+    weights = np.atleast_2d(np.asarray(weights, dtype=np.float64))
+    if weights.shape[1] != len(components):
+        raise Exception, "weights need one column per component hypothesis!"
+
+    pattern, values = align_components(components)
+    n, m = pattern.shape
+    if counts.shape != (n, m):
+        raise Exception, "counts need to be of the same shape as the component hypotheses!"
+
+    # count side, computed once
+    counts = counts.tocoo()
+    keep = counts.data > 0
+    count_rows, count_cols = counts.row[keep], counts.col[keep]
+    count_data = counts.data[keep].astype(np.float64)
+    row_totals = np.bincount(count_rows, weights=count_data, minlength=n)
+    active_rows = np.where(row_totals > 0)[0]
+    active_totals = row_totals[active_rows]
+
+    pattern_rows = np.repeat(np.arange(n), np.diff(pattern.indptr))
+    pattern_keys = pattern_rows * m + pattern.indices
+    count_keys = count_rows.astype(np.int64) * m + count_cols
+    if pattern.nnz > 0:
+        pos = np.minimum(np.searchsorted(pattern_keys, count_keys), pattern.nnz - 1)
+        in_pattern = pattern_keys[pos] == count_keys
+    else:
+        pos = np.zeros(len(count_keys), dtype=np.int64)
+        in_pattern = np.zeros(len(count_keys), dtype=bool)
+    zero_fill = zero_row_values(count_cols, m, chips, mode)
+
+    if batch_size is None:
+        # mixed, floored, keys, order, ranks and the comparison mask (or alpha and its temporaries)
+        batch_size = max(1, int(memory_budget // (48 * max(pattern.nnz, len(count_keys), n, 1))))
+
+    evidences = np.empty(weights.shape[0])
+    for b in xrange(0, weights.shape[0], batch_size):
+        prior_values, zero_rows = mixture_prior_values(pattern, values, weights[b:b+batch_size], chips, mode)
+
+        if pattern.nnz > 0:
+            alpha = np.where(in_pattern, prior_values[:, pos], 0.)
+        else:
+            alpha = np.zeros((prior_values.shape[0], len(count_keys)))
+        # each row with belief receives exactly chips pseudo clicks
+        alpha_sums = np.full((alpha.shape[0], len(active_rows)), float(chips))
+        if dist_zero_rows:
+            alpha = np.where(zero_rows[:, count_rows], zero_fill, alpha)
+        else:
+            alpha_sums[zero_rows[:, active_rows]] = 0.
+        alpha += flat_prior
+        alpha_sums += flat_prior * m
+
+        evidences[b:b+batch_size] = (gammaln(alpha + count_data) - gammaln(alpha)).sum(axis=1) + \
+                                    (gammaln(alpha_sums) - gammaln(alpha_sums + active_totals)).sum(axis=1)
+
+    return weights[np.argmax(evidences)], evidences
@@ -0,0 +1,141 @@
+from __future__ import division
+
+__author__ = 'psinger'
+
+# Row-block scheduler for the row-based (trial) roulette method (see distr_chips_row).
+# Instead of one joblib task per row (each slice pickled to a worker and back), the CSR data
+# is placed in memmaps once; workers receive contiguous row blocks balanced by nnz and write
+# their pseudo clicks directly into a preallocated output array with the input's sparsity pattern.
+
+import os
+import random
+import shutil
+import tempfile
+import numpy as np
+from hyptrails.trial_roulette import chips_dtype
+from hyptrails.pipeline import row_blocks
+
+def distr_chips_block(data, indptr, out, start, end, chips, norm=True):
+    '''
+    Row-based (trial) roulette method for a block of rows of a CSR matrix (see distr_chips_row)
+    Remainder ties are resolved by column order.
+    :param data: CSR data array (may be a memmap)
+    :param indptr: CSR indptr array (may be a memmap)
+    :param out: output array aligned with data (may be a writable memmap)
+    :param start: first row of the block
+    :param end: end (exclusive) row of the block
+    :param chips: number of (single row) chips C to distribute
+    :param norm: set False if rows do not need to be normalized
+    :return: array with the rows of the block without any belief (they are left for the caller)
+    '''
+
+    lo, hi = int(indptr[start]), int(indptr[end])
+    ptr = np.asarray(indptr[start:end+1], dtype=np.int64) - lo
+    lengths = np.diff(ptr)
+    rows = np.repeat(np.arange(end - start), lengths)
+    nonempty = lengths > 0
+
+    vals = np.asarray(data[lo:hi], dtype=np.float64)
+
+    row_sums = np.zeros(end - start)
+    if hi > lo:
+        row_sums[nonempty] = np.add.reduceat(vals, ptr[:-1][nonempty])
+    zero_rows = row_sums == 0
+
+    if norm:
+        sums = row_sums.copy()
+        sums[zero_rows] = 1.
+        vals /= sums[rows]
+
+    vals *= chips
+    floored = np.floor(vals)
+
+    rest = np.zeros(end - start)
+    if hi > lo:
+        rest[nonempty] = chips - np.add.reduceat(floored, ptr[:-1][nonempty])
+    rest[zero_rows] = 0
+
+    # rank the remainders within each row (largest first); keys sort by row first and by
+    # decreasing remainder second
+    order = np.argsort(rows * 2. + (1. - (vals - floored)), kind='mergesort')
+    ranks = np.empty(order.shape[0], dtype=np.int64)
+    ranks[order] = np.arange(order.shape[0]) - ptr[rows]
+
+    floored += ranks < rest[rows]
+    out[lo:hi] = floored
+
+    return np.where(zero_rows)[0] + start
+
+def distr_chips_row_blocks(matrix, chips, n_jobs=-1, norm=True, dist_zero_rows=True, blocks_per_job=4,
+                           temp_folder=None):
+    '''
+    Row-based (trial) roulette method ("integers" mode) with a row-block scheduler (see distr_chips_row).
+    The data and indptr arrays are placed in memmaps in temp_folder once; workers receive contiguous
+    row blocks balanced by nnz and write into a shared preallocated output.
+    :param matrix: csr_matrix A_k expressing theory H_k
+    :param chips: number of (single row) chips C to distribute
+    :param n_jobs: number of jobs, default -1
+    :param norm: set False if matrix does not need to be normalized (row-based)
+    :param dist_zero_rows: if set to False, the method does not distribute chips to rows with only zeros
+    :param blocks_per_job: number of blocks per job; more blocks even out rows of very different cost
+    :param temp_folder: folder for the memmaps; defaults to the system's temporary folder
+    :return: Dirichlet hyperparameters in the shape of a matrix
+    '''
+    from joblib import Parallel, delayed, cpu_count
+    from scipy.sparse import csr_matrix, coo_matrix
+
+    chips = float(chips)
+
+    if float(chips).is_integer() == False:
+        raise Exception, "Only use integer chip counts!"
+
+    n, m = matrix.shape
+    nnz = matrix.indptr[-1]
+    dtype = chips_dtype(chips)
+
+    if n_jobs < 0:
+        n_jobs = max(cpu_count() + 1 + n_jobs, 1)
+
+    blocks = row_blocks(matrix.indptr, n_jobs * blocks_per_job)
+
+    if n_jobs == 1 or nnz == 0:
+        out = np.zeros(nnz, dtype=dtype)
+        zero_rows = [distr_chips_block(matrix.data, matrix.indptr, out, s, e, chips, norm) for s, e in blocks]
+    else:
+        folder = tempfile.mkdtemp(dir=temp_folder)
+        try:
+            data = np.memmap(os.path.join(folder, 'data'), dtype=matrix.data.dtype, mode='w+', shape=(nnz,))
+            data[:] = matrix.data[:nnz]
+            indptr = np.memmap(os.path.join(folder, 'indptr'), dtype=matrix.indptr.dtype, mode='w+',
+                               shape=matrix.indptr.shape)
+            indptr[:] = matrix.indptr
+            out = np.memmap(os.path.join(folder, 'out'), dtype=dtype, mode='w+', shape=(nnz,))
+
+            # memmaps are handed to the workers by filename, not by value; the tasks are built with a
+            # list comprehension, as a generator expression would keep data and indptr in a closure
+            tasks = [delayed(distr_chips_block)(data, indptr, out, s, e, chips, norm) for s, e in blocks]
+            zero_rows = Parallel(n_jobs=n_jobs)(tasks)
+            out = np.array(out)
+            del data, indptr, tasks
+        finally:
+            shutil.rmtree(folder, ignore_errors=True)
+
+    ret = csr_matrix((out, matrix.indices[:nnz].copy(), matrix.indptr.copy()), shape=(n, m))
+
+    zero_rows = np.concatenate(zero_rows) if len(zero_rows) > 0 else np.zeros(0, dtype=np.int64)
+    if dist_zero_rows and len(zero_rows) > 0:
+        # if some rows have 100% sparsity, we equally distribute the chips (see distr_chips)
+        x = int(chips / m)
+        fill = np.empty((len(zero_rows), m), dtype=dtype)
+        fill[:] = x
+        rest = int(chips - x * m)
+        if rest != 0:
+            for r in xrange(len(zero_rows)):
+                fill[r, random.sample(range(m), rest)] += 1
+        ret = ret + coo_matrix((fill.ravel(), (np.repeat(zero_rows, m), np.tile(np.arange(m), len(zero_rows)))),
+                               shape=(n, m))
+        ret = ret.tocsr().astype(dtype)
+
+    ret.eliminate_zeros()
+
+    return ret
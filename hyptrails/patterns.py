@@ -0,0 +1,87 @@
+from __future__ import division
+
+__author__ = 'psinger'
+
+# Deduplication of identical hypothesis rows. Structured hypotheses (e.g., graph hypotheses where
+# many nodes share the same neighbourhood) repeat the same (normalized) row many times; here each
+# unique row pattern is elicited once and the prior is kept as a pattern table plus a
+# row -> pattern index. hyptrails.evidence consumes this compact form directly.
+
+import numpy as np
+from hyptrails.trial_roulette import distr_chips_row
+
+def row_patterns(matrix, norm=True, decimals=12, share_empty=True):
+    '''
+    Fingerprints the rows of a matrix by their columns and (row-normalized) values
+    :param matrix: csr_matrix (not modified)
+    :param norm: set False if rows should be compared without normalizing them first
+    :param decimals: values are compared after rounding to this many decimals, so that rows that only
+                     differ by floating point noise of the normalization (e.g., scaled copies) match
+    :param share_empty: set False to give each row without any belief (row sum 0) a pattern of its own,
+                        e.g., because each of them receives its own random chips
+    :return: tuple (representatives, row_pattern); representatives holds the first row of each unique
+             pattern and row_pattern the pattern index of each row
+    '''
+
+    matrix = matrix.tocsr().copy()
+    matrix.sum_duplicates()
+    indptr, indices = matrix.indptr, matrix.indices
+    data = matrix.data.astype(np.float64)
+
+    sums = np.asarray(matrix.sum(axis=1), dtype=np.float64).ravel()
+    empty = sums == 0
+    if norm:
+        sums[empty] = 1.
+        data = data / np.repeat(sums, np.diff(indptr))
+    if decimals is not None:
+        # adding 0. turns negative zeros into zeros
+        data = np.round(data, decimals) + 0.
+
+    patterns = {}
+    representatives = []
+    row_pattern = np.empty(matrix.shape[0], dtype=np.int64)
+    for i in xrange(matrix.shape[0]):
+        s, e = indptr[i], indptr[i+1]
+        if empty[i] and not share_empty:
+            key = i
+        else:
+            key = (indices[s:e].tobytes(), data[s:e].tobytes())
+        p = patterns.get(key)
+        if p is None:
+            p = patterns[key] = len(representatives)
+            representatives.append(i)
+        row_pattern[i] = p
+
+    return np.array(representatives, dtype=np.int64), row_pattern
+
+def distr_chips_row_patterns(matrix, chips, n_jobs=-1, norm=True, dist_zero_rows=True, mode="integers",
+                             scheduler="rows"):
+    '''
+    Row-based (trial) roulette method (see distr_chips_row) that elicits each unique row pattern only once
+    :param matrix: csr_matrix A_k expressing theory H_k
+    :param chips: number of (single row) chips C to distribute
+    :param n_jobs: number of jobs, default -1
+    :param norm: set False if matrix does not need to be normalized (row-based)
+    :param dist_zero_rows: if set to False, the method does not distribute chips to rows with only zeros
+    :param mode: "integers" or "reals" (see distr_chips_row)
+    :param scheduler: "rows" or "blocks" (see distr_chips_row)
+    :return: tuple (table, row_pattern); table holds the Dirichlet hyperparameters of each unique pattern
+             (one row per pattern) and row_pattern the pattern index of each row of matrix
+    '''
+
+    # rows without any belief receive their own random chips (see distr_chips_row), so they are not shared
+    representatives, row_pattern = row_patterns(matrix, norm, share_empty=not dist_zero_rows)
+    table = distr_chips_row(matrix.tocsr()[representatives], chips, n_jobs=n_jobs, norm=norm,
+                            dist_zero_rows=dist_zero_rows, mode=mode, scheduler=scheduler)
+
+    return table.tocsr(), row_pattern
+
+def expand_patterns(table, row_pattern):
+    '''
+    Expands a compact prior (see distr_chips_row_patterns) into a full matrix
+    :param table: Dirichlet hyperparameters of each unique pattern
+    :param row_pattern: pattern index of each row
+    :return: Dirichlet hyperparameters in the shape of a matrix
+    '''
+
+    return table.tocsr()[row_pattern]
@@ -0,0 +1,129 @@
+from __future__ import division
+
+__author__ = 'psinger'
+
+# Pipelined block I/O for the out-of-core (hdf5) methods. Upcoming blocks are read (and
+# decompressed) by a background thread into a bounded ring of reusable buffers while the current
+# block is transformed; output blocks are written by another background thread. The HDF5 library
+# is usually not built thread-safe, so all HDF5 calls of the pipeline are serialized by hdf5_lock;
+# callers need to hold it for their own HDF5 calls while a pipeline is active.
+
+import threading
+from collections import deque
+from multiprocessing.pool import ThreadPool
+import numpy as np
+
+hdf5_lock = threading.RLock()
+
+def row_blocks(indptr, n_blocks):
+    '''
+    Splits the rows of a CSR matrix into contiguous blocks with roughly the same number of elements
+    A single row is never split, so very long rows form blocks on their own.
+    :param indptr: CSR indptr array
+    :param n_blocks: (maximum) number of blocks
+    :return: list of (start, end) row ranges
+    '''
+
+    n = indptr.shape[0] - 1
+    targets = np.linspace(0, indptr[-1], n_blocks + 1)[1:-1]
+    bounds = np.unique(np.concatenate(([0], np.searchsorted(indptr, targets), [n])))
+    return [(int(s), int(e)) for s, e in zip(bounds[:-1], bounds[1:]) if e > s]
+
+def block_rows(node, target_bytes=1 << 22):
+    '''
+    Block size (number of rows) for iterating over an hdf5 array
+    Blocks consist of whole chunks, so that no chunk is decompressed twice, and hold about target_bytes.
+    :param node: PyTables array (e.g., carray)
+    :param target_bytes: (approximate) size of a block in bytes
+    :return: number of rows
+    '''
+
+    row_bytes = node.dtype.itemsize * int(np.prod(node.shape[1:]))
+    chunk = node.chunkshape[0] if node.chunkshape is not None else 1
+    return int(chunk * max(target_bytes // max(chunk * row_bytes, 1), 1))
+
+def read_blocks(node, start, stop, bl, prefetch=2):
+    '''
+    Iterates over blocks of rows of an hdf5 array; the next prefetch blocks are read by a background thread
+    The blocks are views of a ring of prefetch + 1 reusable buffers, i.e., a block is only valid until
+    the next one is requested and needs to be copied if it is kept.
+    :param node: PyTables array (e.g., carray)
+    :param start: first row
+    :param stop: end (exclusive) row
+    :param bl: number of rows of a block
+    :param prefetch: number of blocks read ahead
+    :return: generator of tuples (i, block) with the first row i of each block
+    '''
+
+    starts = range(start, stop, bl)
+    if len(starts) == 0:
+        return
+
+    ring = [np.empty((min(bl, stop - start),) + node.shape[1:], dtype=node.dtype) for _ in xrange(prefetch + 1)]
+
+    def read(k):
+        i = starts[k]
+        buf = ring[k % len(ring)][:min(bl, stop - i)]
+        with hdf5_lock:
+            node.read(i, i + buf.shape[0], out=buf)
+        return buf
+
+    pool = ThreadPool(1)
+    try:
+        pending = deque(pool.apply_async(read, (k,)) for k in xrange(min(prefetch, len(starts))))
+        for k in xrange(len(starts)):
+            # block k + prefetch goes to the buffer of block k - 1, which is not used anymore
+            if k + prefetch < len(starts):
+                pending.append(pool.apply_async(read, (k + prefetch,)))
+            yield starts[k], pending.popleft().get()
+    finally:
+        # outstanding reads are finished before the caller may close the file
+        pool.close()
+        pool.join()
+
+class BlockWriter(object):
+    '''
+    Writes blocks into hdf5 arrays with a background thread
+    At most max_pending blocks are queued; write() waits for the oldest one if there are more.
+    The written arrays must not be modified by the caller afterwards.
+    '''
+
+    def __init__(self, max_pending=2):
+        '''
+        :param max_pending: number of blocks that may be queued
+        '''
+        self.pool = ThreadPool(1)
+        self.pending = deque()
+        self.max_pending = max_pending
+
+    def _write(self, node, start, values):
+        with hdf5_lock:
+            node[start:start + values.shape[0]] = values
+
+    def write(self, node, start, values):
+        '''
+        Queues values to be written to node[start:start + len(values)]
+        :param node: PyTables array
+        :param start: first row
+        :param values: array with the rows
+        '''
+        while len(self.pending) >= self.max_pending:
+            self.pending.popleft().get()
+        self.pending.append(self.pool.apply_async(self._write, (node, start, values)))
+
+    def wait(self):
+        '''
+        Waits until all queued blocks are written; errors of the writes are raised here
+        '''
+        while len(self.pending) > 0:
+            self.pending.popleft().get()
+
+    def close(self):
+        '''
+        Writes all queued blocks and stops the background thread
+        '''
+        try:
+            self.wait()
+        finally:
+            self.pool.close()
+            self.pool.join()
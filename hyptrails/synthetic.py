@@ -0,0 +1,193 @@
+from __future__ import division
+
+__author__ = 'psinger'
+
+# Synthetic trails for load testing elicitation and evidence. Random walkers move through a
+# (hypothesis or transition) matrix; many walks advance at once and the next state of each walker
+# is drawn from the cumulative weights of its current row. Trails are produced in batches, so
+# that large corpora can be streamed to a trail file (see data/) or into transition counts.
+
+import numpy as np
+from scipy.sparse import coo_matrix
+
+def cumulative_weights(matrix):
+    '''
+    Cumulative weights of a CSR matrix, running over all rows
+    :param matrix: csr_matrix with nonnegative transition weights
+    :return: tuple (cum, row_start, row_sums); cum is the running sum of the data, row_start the value
+             of cum before each row and row_sums the sum of each row
+    '''
+
+    data = matrix.data.astype(np.float64)
+    if (data < 0).any():
+        raise Exception, "Transition weights need to be nonnegative!"
+
+    cum = np.cumsum(data)
+    row_start = np.concatenate(([0.], cum))[matrix.indptr[:-1]]
+    row_end = np.concatenate(([0.], cum))[matrix.indptr[1:]]
+
+    return cum, row_start, row_end - row_start
+
+def row_search(cum, indptr, rows, target, steps):
+    '''
+    Vectorized binary search of targets within the cumulative weights of their rows
+    (searchsorted(cum, target, side='right') restricted to each row)
+    :param cum: cumulative weights (see cumulative_weights)
+    :param indptr: CSR indptr array
+    :param rows: row of each target
+    :param target: targets
+    :param steps: number of bisection steps; ceil(log2(longest row)) suffices
+    :return: array with the position of the first element of each row whose cumulative weight exceeds
+             the target (the last element of the row if there is none, e.g., due to floating point drift)
+    '''
+
+    lo = indptr[rows]
+    hi = indptr[rows+1] - 1
+    for _ in xrange(steps):
+        mid = (lo + hi) // 2
+        right = cum[mid] <= target
+        lo = np.where(right, mid + 1, lo)
+        hi = np.where(right, hi, mid)
+
+    return lo
+
+def random_walks(matrix, n_trails, length, seed=None, start=None, batch_size=100000):
+    '''
+    Simulates random walks through a matrix, batch by batch
+    A walker stops early if it reaches a row without any weight.
+    :param matrix: csr_matrix with transition weights (e.g., a hypothesis or transition matrix); rows do
+                   not need to be normalized
+    :param n_trails: number of trails
+    :param length: number of states of each trail; either an int or a tuple (low, high) for trail lengths
+                   drawn uniformly from low to high (both inclusive)
+    :param seed: seed of the random number generator
+    :param start: array with the start state of each trail; drawn uniformly from all states if not given
+    :param batch_size: number of trails simulated at once
+    :return: generator of tuples (walks, lengths); walks is an array of shape (batch, maximum length) with
+             the states of each trail (only the first lengths[i] columns of row i are valid)
+    '''
+
+    matrix = matrix.tocsr()
+    if not matrix.has_canonical_format:
+        # tocsr() does not copy csr matrices; the caller's matrix is left untouched
+        matrix = matrix.copy()
+        matrix.sum_duplicates()
+    n = matrix.shape[0]
+    if matrix.shape[1] != n:
+        raise Exception, "The matrix needs to be square!"
+
+    rng = np.random.RandomState(seed)
+
+    if isinstance(length, tuple):
+        low, high = length
+    else:
+        low, high = length, length
+    if low < 1 or high < low:
+        raise Exception, "Trail lengths need to be positive!"
+
+    if start is not None:
+        start = np.asarray(start, dtype=np.int64)
+        if start.shape[0] != n_trails:
+            raise Exception, "One start state per trail needs to be given!"
+
+    cum, row_start, row_sums = cumulative_weights(matrix)
+    indptr = matrix.indptr.astype(np.int64)
+    indices = matrix.indices.astype(np.int64)
+    # number of bisection steps for the longest row
+    steps = int(np.ceil(np.log2(max(np.diff(indptr).max() if n > 0 else 1, 1))))
+
+    for b in xrange(0, n_trails, batch_size):
+        size = min(batch_size, n_trails - b)
+
+        lengths = rng.randint(low, high + 1, size=size)
+        if start is None:
+            current = rng.randint(0, n, size=size).astype(np.int64)
+        else:
+            current = start[b:b+size].copy()
+
+        walks = np.zeros((size, lengths.max()), dtype=np.int64)
+        walks[:, 0] = current
+        active = np.where(lengths > 1)[0]
+        for t in xrange(1, walks.shape[1]):
+            # walkers in rows without any weight end their trail here
+            dead = row_sums[current[active]] <= 0
+            lengths[active[dead]] = t
+            active = active[~dead]
+            if active.shape[0] == 0:
+                break
+
+            s = current[active]
+            target = row_start[s] + rng.random_sample(active.shape[0]) * row_sums[s]
+            current[active] = indices[row_search(cum, indptr, s, target, steps)]
+            walks[active, t] = current[active]
+
+            active = active[lengths[active] > t + 1]
+
+        yield walks, lengths
+
+def generate_trails(matrix, n_trails, length, seed=None, start=None, batch_size=100000):
+    '''
+    Synthetic trails (see random_walks)
+    :param matrix: csr_matrix with transition weights
+    :param n_trails: number of trails
+    :param length: int or tuple (low, high) of trail lengths
+    :param seed: seed of the random number generator
+    :param start: array with the start state of each trail
+    :param batch_size: number of trails simulated at once
+    :return: generator of trails (arrays of states)
+    '''
+
+    for walks, lengths in random_walks(matrix, n_trails, length, seed, start, batch_size):
+        for i in xrange(walks.shape[0]):
+            yield walks[i, :lengths[i]]
+
+def write_trails(filename, matrix, n_trails, length, seed=None, start=None, labels=None, batch_size=100000):
+    '''
+    Writes synthetic trails (see random_walks) in the trail-file format of the data folder, i.e.,
+    one trail per line with space-separated states
+    :param filename: name of the trail file
+    :param matrix: csr_matrix with transition weights
+    :param n_trails: number of trails
+    :param length: int or tuple (low, high) of trail lengths
+    :param seed: seed of the random number generator
+    :param start: array with the start state of each trail
+    :param labels: labels of the states; states are written as their indices if not given
+    :param batch_size: number of trails simulated at once
+    :return: number of transitions written
+    '''
+
+    if labels is not None:
+        labels = np.asarray(labels, dtype=str)
+
+    transitions = 0
+    with open(filename, "w") as f:
+        for walks, lengths in random_walks(matrix, n_trails, length, seed, start, batch_size):
+            names = walks.astype(str) if labels is None else labels[walks]
+            f.write("".join(" ".join(names[i, :lengths[i]]) + "\n" for i in xrange(walks.shape[0])))
+            transitions += int((lengths - 1).sum())
+
+    return transitions
+
+def trail_counts(matrix, n_trails, length, seed=None, start=None, batch_size=100000):
+    '''
+    Transition counts of synthetic trails (see random_walks) without materializing the trails;
+    the result equals hyptrails.evidence.transition_counts of the generated trails
+    :param matrix: csr_matrix with transition weights
+    :param n_trails: number of trails
+    :param length: int or tuple (low, high) of trail lengths
+    :param seed: seed of the random number generator
+    :param start: array with the start state of each trail
+    :param batch_size: number of trails simulated at once
+    :return: csr_matrix with transition counts
+    '''
+
+    n = matrix.shape[0]
+    counts = coo_matrix((n, n), dtype=np.float64).tocsr()
+    for walks, lengths in random_walks(matrix, n_trails, length, seed, start, batch_size):
+        valid = np.arange(walks.shape[1] - 1) < (lengths[:, None] - 1)
+        rows = walks[:, :-1][valid]
+        cols = walks[:, 1:][valid]
+        # duplicates are summed up when converting to csr
+        counts = counts + coo_matrix((np.ones(rows.shape[0]), (rows, cols)), shape=(n, n)).tocsr()
+
+    return counts
@@ -2,14 +2,35 @@ from __future__ import division
 
 __author__ = 'psinger'
 
-import tables as tb
-import time
-import scipy
+# Only NumPy is imported eagerly. This module is re-imported by every joblib worker
+# spawned in distr_chips_row, so scipy, joblib and PyTables (see hyptrails.hdf5)
+# are loaded lazily where they are actually needed.
 import numpy as np
-import sys
 import random
-from joblib import Parallel, delayed
-from scipy.sparse.sparsetools import csr_scale_rows
+
+####dtype helpers#####
+
+def index_dtype(n):
+    '''
+    Smallest index dtype (int32 or int64) for CSR indices and indptr
+    :param n: largest value that needs to be stored (i.e., nnz or number of columns)
+    :return: numpy dtype
+    '''
+    if n < np.iinfo(np.int32).max:
+        return np.dtype(np.int32)
+    return np.dtype(np.int64)
+
+def chips_dtype(chips):
+    '''
+    Smallest unsigned dtype that can hold the integer pseudo clicks when distributing chips;
+    no single element can receive more than all chips
+    :param chips: number of chips C to distribute
+    :return: numpy dtype
+    '''
+    for dtype in (np.uint16, np.uint32):
+        if chips <= np.iinfo(dtype).max:
+            return np.dtype(dtype)
+    return np.dtype(np.uint64)
 
 ####CSR_MATRIX methods#####
 
@@ -27,7 +48,8 @@ def distr_chips(matrix, chips, matrix_sum_final = None, norm=True, dist_zero_mat
                             (only zeros); use with caution
     :param mode: sets the mode of the distribution; "integers" means that the distributed pseudo clicks are integers;
                  "reals" means that the pseudo clicks (hyperparameters) can also be positive reals
-    :return: Dirichlet hyperparameters in the shape of a matrix
+    :return: Dirichlet hyperparameters in the shape of a matrix; in "integers" mode the dtype
+             is the smallest unsigned integer type holding all chips (see chips_dtype)
     '''
 
     if mode not in ['integers', 'reals']:
@@ -39,6 +61,7 @@ def distr_chips(matrix, chips, matrix_sum_final = None, norm=True, dist_zero_mat
         raise Exception, "If mode is 'integers' then only use integer chip counts!"
 
     if mode == "integers":
+        dtype = chips_dtype(chips)
         nnz = matrix.nnz
         if nnz== 0:
             if dist_zero_matrix:
@@ -51,9 +74,9 @@ def distr_chips(matrix, chips, matrix_sum_final = None, norm=True, dist_zero_mat
                     eles = matrix.data.shape[0]
                     idx = random.sample(range(eles),int(rest))
                     matrix.data[idx] += 1
-                return matrix
+                return matrix.astype(dtype)
             else:
-                return matrix
+                return matrix.astype(dtype)
         if norm:
             if matrix_sum_final is None:
                 matrix_sum_final = matrix.sum()
@@ -85,7 +108,7 @@ def distr_chips(matrix, chips, matrix_sum_final = None, norm=True, dist_zero_mat
         floored.eliminate_zeros()
         del matrix
 
-        return floored
+        return floored.astype(dtype)
 
     if mode == "reals":
         if dist_zero_matrix:
@@ -107,7 +130,8 @@ def distr_chips(matrix, chips, matrix_sum_final = None, norm=True, dist_zero_mat
 
         return matrix
 
-def distr_chips_row(matrix, chips, n_jobs=-1, norm=True, dist_zero_rows=True, mode="integers"):
+def distr_chips_row(matrix, chips, n_jobs=-1, norm=True, dist_zero_rows=True, mode="integers", scheduler="rows",
+                    dedupe=False):
     '''
     Trial roulette method for eliciting Dirichlet priors from expressed hypothesis matrix.
     This function works row-based. Thus, each row will receive the given number of chips!!!
@@ -118,17 +142,33 @@ def distr_chips_row(matrix, chips, n_jobs=-1, norm=True, dist_zero_rows=True, mo
     :param dist_zero_rows: if set to False, the method does not distribute chips to rows with only zeros (use with caution)
     :param mode: sets the mode of the distribution; "integers" means that the distributed pseudo clicks are integers;
                  "reals" means that the pseudo clicks (hyperparameters) can also be positive reals
-    :return: Dirichlet hyperparameters in the shape of a matrix
+    :param scheduler: parallelization of the "integers" mode; "rows" sends each row to a joblib worker,
+                      "blocks" uses shared memory and nnz-balanced row blocks (see hyptrails.parallel)
+    :param dedupe: set True to elicit each unique (normalized) row only once; the result is then returned in
+                   the compact form (table, row_pattern) (see hyptrails.patterns.distr_chips_row_patterns)
+    :return: Dirichlet hyperparameters in the shape of a matrix; in "integers" mode the dtype
+             is the smallest unsigned integer type holding the row chips (see chips_dtype)
     '''
 
     if mode not in ['integers', 'reals']:
         raise Exception, "Mode needs to be 'integers' or 'reals'!"
 
+    if scheduler not in ['rows', 'blocks']:
+        raise Exception, "Scheduler needs to be 'rows' or 'blocks'!"
+
+    if dedupe:
+        from hyptrails.patterns import distr_chips_row_patterns
+        return distr_chips_row_patterns(matrix, chips, n_jobs=n_jobs, norm=norm, dist_zero_rows=dist_zero_rows,
+                                        mode=mode, scheduler=scheduler)
+
     chips = float(chips)
 
     if float(chips).is_integer() == False and mode == "integers":
         raise Exception, "If mode is 'integers' then only use integer chip counts!"
 
+    from scipy.sparse import vstack
+    from scipy.sparse.sparsetools import csr_scale_rows
+
     if norm == True:
         norma = matrix.sum(axis=1)
         n_nzeros = np.where(norma > 0)
@@ -138,9 +178,19 @@ def distr_chips_row(matrix, chips, n_jobs=-1, norm=True, dist_zero_rows=True, mo
         csr_scale_rows(matrix.shape[0], matrix.shape[1], matrix.indptr, matrix.indices,
                        matrix.data, norma)
 
+    if mode == "integers" and scheduler == "blocks":
+        from hyptrails.parallel import distr_chips_row_blocks
+        # rows have already been normalized above
+        return distr_chips_row_blocks(matrix, chips, n_jobs=n_jobs, norm=False, dist_zero_rows=dist_zero_rows)
+
     if mode == "integers":
-        r = Parallel(n_jobs=n_jobs)(delayed(distr_chips)(matrix[i,:],chips,dist_zero_matrix=dist_zero_rows,norm=False) for i in xrange(matrix.shape[0]))
-        return scipy.sparse.vstack(r)
+        if n_jobs == 1:
+            # no need to start up (and import) joblib for a serial run
+            r = [distr_chips(matrix[i,:],chips,dist_zero_matrix=dist_zero_rows,norm=False) for i in xrange(matrix.shape[0])]
+        else:
+            from joblib import Parallel, delayed
+            r = Parallel(n_jobs=n_jobs)(delayed(distr_chips)(matrix[i,:],chips,dist_zero_matrix=dist_zero_rows,norm=False) for i in xrange(matrix.shape[0]))
+        return vstack(r)
 
     if mode == "reals":
         matrix = matrix * chips
@@ -162,259 +212,26 @@ def distr_chips_row(matrix, chips, n_jobs=-1, norm=True, dist_zero_rows=True, mo
 
 #####HDF5 Methods#####
 
-# Note that the following HDF5 methods only support the "integers" mode at the moment.
-# Furthermore, no dedicated row-based methods are available
-# Preferably, the sparse methods above should be utilized as they offer more functionality
-# and as they are more rigorously tested
+# The HDF5 methods live in hyptrails.hdf5; the following aliases keep them available
+# from this module without importing PyTables until they are first called.
 
-def hdf5_save(matrix, filename, dtype=np.dtype(np.float64)):
+def hdf5_save(*args, **kwargs):
     '''
-    Helper function for storing scipy matrices as PyTables HDF5 matrices
-    see http://www.philippsinger.info/?p=464 for further information
-    :param matrix: matrix to store
-    :param filename: filename for storage
-    :param dtype: dtype
-    :return: True
+    Lazy alias for hyptrails.hdf5.hdf5_save
     '''
+    from hyptrails import hdf5
+    return hdf5.hdf5_save(*args, **kwargs)
 
-    #print matrix.shape
-
-    atom = tb.Atom.from_dtype(dtype)
-
-    f = tb.open_file(filename, 'w')
-
-    #print "saving data"
-    filters = tb.Filters(complevel=5, complib='blosc')
-    out = f.create_carray(f.root, 'data', atom, shape=matrix.data.shape, filters=filters)
-    out[:] = matrix.data
-
-    #print "saving indices"
-    out = f.create_carray(f.root, 'indices', tb.Int32Atom(), shape=matrix.indices.shape, filters=filters)
-    out[:] = matrix.indices
-
-    #print "saving indptr"
-    out = f.create_carray(f.root, 'indptr', tb.Int32Atom(), shape=matrix.indptr.shape, filters=filters)
-    out[:] = matrix.indptr
-
-    #print "saving done"
-
-    f.close()
-
-    return
-
-def distr_chips_hdf5(file, chips, matrix_sum_final, out_name, norm=True):
+def distr_chips_hdf5(*args, **kwargs):
     '''
-    HDF5 (PyTables) version of the trial roulette method for eliciting Dirichlet priors from
-    expressed hypothesis matrix.
-    Note that only the informative part is done here.
-    This works for densely stored hdf5 matrices (i.e., single data matrix).
-    :param file: hdf5 filename where hypothesis matrix A is stored
-    :param chips: number of chips C to distribute
-    :param matrix_sum_final: the final sum of the input matrix, needs to be pre-calculated
-    :param out_name: filename of new file
-    :param norm: set False if matrix does not need to be normalized
-    :return: True
+    Lazy alias for hyptrails.hdf5.distr_chips_hdf5
     '''
+    from hyptrails import hdf5
+    return hdf5.distr_chips_hdf5(*args, **kwargs)
 
-    h5 = tb.open_file(file, "r")
-
-    matrix = h5.root.data
-
-    #print matrix[:]
-
-    l = matrix.shape[0]
-    k = matrix.shape[1]
-
-    #print matrix[0]
-
-    bl = 1000
-    t0= time.time()
-
-    # dtype may need to be altered
-    floored = scipy.sparse.lil_matrix((l, k), dtype=np.uint16)
-    rest = scipy.sparse.lil_matrix((l, k), dtype=np.float32)
-    #print floored.dtype
-
-    matrix_sum = 0.
-    nnz_sum = 0.
-    flushme = 0
-    for i in range(0, l, bl):
-        #print i
-        if norm:
-            rows = matrix[i:min(i+bl, l),:].astype(np.float64) / matrix_sum_final
-        else:
-            rows = matrix[i:min(i+bl, l),:].astype(np.float64)
-        matrix_sum += rows.sum()
-        rows = rows * chips
-        floor_tmp = np.floor(rows)
-        floored[i:min(i+bl, l),:] = floor_tmp
-        rest_tmp = rows - floor_tmp
-        rest[i:min(i+bl, l),:] = rest_tmp
-        #print "nnz floored", floored.nnz
-        #print "nnz rest", rest.nnz
-
-        flushme += 1
-        #if flushme % 1 == 0:
-        #    break
-        #     #print "flushing now"
-        #     #print (time.time()-t0) / 60.
-        #     h5.flush()
-        #     #print "flushing done"
-
-        #print (time.time()-t0) / 60.
-
-    #print "looping done"
-
-    floored = floored.tocsr()
-    rest = rest.tocsr()
-
-    #print "matrix sum", matrix_sum
-
-    floored_sum = floored.sum()
-    #print "floored sum", floored_sum
-
-    rest_sum = int(chips - floored_sum)
-
-    if rest_sum > 0.:
-
-        #print "rest sum", rest_sum
-
-        idx = rest.data.argpartition(-rest_sum)[-rest_sum:]
-
-        #print "indexing rest done"
-
-        i, j = rest.nonzero()
-
-        i_idx = i[idx]
-        j_idx = j[idx]
-
-        if len(i_idx) > 0:
-            floored[i_idx, j_idx] += 1
-
-    del rest
-
-    hdf5_save(floored, out_name)
-
-    h5.close()
-
-    return
-
-def distr_chips_hdf5_sparse(file, chips, matrix_sum_final, out_name, norm=True):
+def distr_chips_hdf5_sparse(*args, **kwargs):
     '''
-    HDF5 (PyTables) version of the trial roulette method for eliciting Dirichlet priors from
-    expressed hypothesis matrix.
-    This version creates a new hdf5 file including the chip distribution.
-    Note that only the informative part is done here.
-    This works for sparsely stored hdf5 matrices.
-    :param file: hdf5 filename where hypothesis matrix A is stored (needs data, indices, indptr fields)
-    :param shape: the shape of the matrix
-    :param chips: number of chips C to distribute
-    :param matrix_sum_final: the final sum of the input matrix, needs to be pre-calculated
-    :param out_name: filename of new file
-    :param norm: set False if matrix does not need to be normalized
-    :return: True
+    Lazy alias for hyptrails.hdf5.distr_chips_hdf5_sparse
     '''
-
-    h5 = tb.open_file(file, "r")
-
-    data = h5.root.data
-    indices = h5.root.indices
-    indptr = h5.root.indptr
-
-    l = data.shape[0]
-
-    bl = 1000
-    t0= time.time()
-
-    atom = tb.Atom.from_dtype(data.dtype)
-
-    f = tb.open_file(out_name, 'w')
-
-    filters = tb.Filters(complevel=5, complib='blosc')
-    data_out = f.create_carray(f.root, 'data', atom, shape=data.shape, filters=filters)
-
-    #print data.shape
-    rest = np.empty(data.shape, dtype=np.float32)
-
-    ##print rest.shape
-    #sys.exit()
-
-    #print "saving indices"
-    indices_out = f.create_carray(f.root, 'indices', tb.Int32Atom(), shape=indices.shape, filters=filters)
-    indices_out[:] = indices[:]
-
-    #print "saving indptr"
-    indptr_out = f.create_carray(f.root, 'indptr', tb.Int32Atom(), shape=indptr.shape, filters=filters)
-    indptr_out[:] = indptr[:]
-
-    matrix_sum = 0.
-    nnz_sum = 0.
-    flushme = 0
-    floored_sum = 0
-    for i in range(0, l, bl):
-        #print i
-        if norm:
-            rows = data[i:min(i+bl, l)].astype(np.float64) / matrix_sum_final
-        else:
-            rows = data[i:min(i+bl, l)].astype(np.float64)
-        matrix_sum += rows.sum()
-        rows = rows * chips
-        floor_tmp = np.floor(rows)
-        data_out[i:min(i+bl, l)] = floor_tmp
-        floored_sum += floor_tmp.sum()
-        rest_tmp = rows - floor_tmp
-        ##print rest_tmp
-        ##print rest[i:min(i+bl, l)]
-        rest[i:min(i+bl, l)] = rest_tmp
-        ##print "nnz floored", floored.nnz
-        ##print "nnz rest", rest.nnz
-
-        flushme += 1
-        #if flushme % 1 == 0:
-        #    break
-        #     #print "flushing now"
-        #     #print (time.time()-t0) / 60.
-        #     h5.flush()
-        #     #print "flushing done"
-
-        #print (time.time()-t0) / 60.
-
-    #print "looping done"
-
-    #floored = floored.tocsr()
-    #rest = rest.tocsr()
-
-    #print "matrix sum", matrix_sum
-
-    #floored_sum = data_out.sum()
-    #print "floored sum", floored_sum
-
-    rest_sum = int(chips - floored_sum)
-
-    if rest_sum > 0.:
-
-    #print "rest sum", rest_sum
-
-        idx = rest.argpartition(-rest_sum)[-rest_sum:]
-
-        #print "indexing rest done"
-
-        data_out[idx] += 1
-
-        #print "incrementing index done"
-
-        #floored_sum = data_out.sum()
-        #print "final floored sum", floored_sum
-
-        ##print rest.data.shape, data_out.data.shape
-
-        assert(rest.shape == data_out.shape)
-
-    del rest
-
-    h5.close()
-    f.close()
-
-    #hdf5_save(floored, "file.h5")
-
-    return
\ No newline at end of file
+    from hyptrails import hdf5
+    return hdf5.distr_chips_hdf5_sparse(*args, **kwargs)
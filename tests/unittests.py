@@ -7,7 +7,11 @@ from scipy.sparse import rand, lil_matrix, csr_matrix, vstack
 from sklearn.preprocessing import normalize
 from hyptrails.trial_roulette import *
 from pathtools.markovchain import MarkovChain
+import tables as tb
+import numpy as np
 import os
+import subprocess
+import sys
 
 class TestFunctions(unittest.TestCase):
 
@@ -142,6 +146,481 @@ class TestFunctions(unittest.TestCase):
 
         np.testing.assert_array_equal(ret1.toarray(), ret2.toarray())
 
+    def test_distr_chips_row_serial(self):
+        ret1 = distr_chips_row(self.matrix.copy(), self.states, n_jobs=1)
+        ret2 = distr_chips_row(self.matrix.copy(), self.states, n_jobs=2)
+
+        self.assertEqual(ret1.sum(), self.states*self.states)
+        np.testing.assert_array_equal(ret1.toarray(), ret2.toarray())
+
+    def test_lazy_imports(self):
+        check = "import sys, hyptrails.trial_roulette; " \
+                "sys.exit(int('tables' in sys.modules or 'joblib' in sys.modules))"
+        self.assertEqual(subprocess.call([sys.executable, "-c", check], cwd=".."), 0)
+
+    def test_compact_dtypes(self):
+        self.assertEqual(chips_dtype(self.states), np.uint16)
+        self.assertEqual(chips_dtype(2**20), np.uint32)
+        self.assertEqual(chips_dtype(2**40), np.uint64)
+        self.assertEqual(index_dtype(2**31 - 2), np.int32)
+        self.assertEqual(index_dtype(2**31), np.int64)
+
+        ret1 = distr_chips(self.matrix.copy(), self.states*self.states)
+        ret2 = distr_chips_row(self.matrix.copy(), self.states, n_jobs=1)
+        self.assertEqual(ret1.dtype, np.uint16)
+        self.assertEqual(ret2.dtype, np.uint16)
+        self.assertEqual(distr_chips(self.matrix, self.states, mode="reals").dtype, np.float64)
+
+    def test_hdf5_save_dtypes(self):
+        ret = distr_chips(self.matrix, self.states*self.states)
+        hdf5_save(ret, "test.hdf5")
+
+        h5 = tb.open_file("test.hdf5", 'r')
+        self.assertEqual(h5.root.data.dtype, np.uint16)
+        self.assertEqual(h5.root.indices.dtype, np.int32)
+        self.assertEqual(h5.root.indptr.dtype, np.int32)
+        h5.close()
+
+        distr_chips_hdf5_sparse("test.hdf5", self.states*self.states, ret.sum(), "out.hdf5")
+
+        h5 = tb.open_file("out.hdf5", 'r')
+        self.assertEqual(h5.root.data.dtype, np.uint16)
+        self.assertEqual(h5.root.data[:].sum(), self.states*self.states)
+        h5.close()
+
+        os.remove("test.hdf5")
+        os.remove("out.hdf5")
+
+    def test_hdf5_stats(self):
+        from hyptrails.hdf5 import hdf5_stats, hdf5_compute_stats
+
+        hdf5_save(self.matrix, "test.hdf5")
+
+        h5 = tb.open_file("test.hdf5", 'r')
+        stats = hdf5_stats(h5)
+        self.assertAlmostEqual(stats['matrix_sum'], self.matrix.sum())
+        self.assertEqual(stats['nnz'], self.matrix.nnz)
+        self.assertEqual(stats['shape'], self.matrix.shape)
+        np.testing.assert_array_almost_equal(stats['row_sums'][:], self.matrix.sum(axis=1).A1)
+        np.testing.assert_array_equal(stats['row_nnz'][:], np.diff(self.matrix.indptr))
+        h5.close()
+
+        ret1 = distr_chips(self.matrix, self.states*self.states)
+        distr_chips_hdf5_sparse("test.hdf5", self.states*self.states, out_name="out.hdf5")
+
+        h5 = tb.open_file("out.hdf5", 'r')
+        ret2 = csr_matrix((h5.root.data[:], h5.root.indices[:], h5.root.indptr[:]), shape=self.matrix.shape)
+        np.testing.assert_array_equal(ret1.toarray(), ret2.toarray())
+
+        stats = hdf5_stats(h5)
+        self.assertEqual(stats['matrix_sum'], self.states*self.states)
+        self.assertEqual(stats['shape'], self.matrix.shape)
+        np.testing.assert_array_equal(stats['row_sums'][:], ret2.sum(axis=1).A1)
+        h5.close()
+
+        os.remove("test.hdf5")
+        os.remove("out.hdf5")
+
+        filters = tb.Filters(complevel=5, complib='blosc')
+        f = tb.open_file("test.hdf5", 'w')
+        out = f.create_carray(f.root, 'data', tb.Float64Atom(), shape=self.matrix.shape, filters=filters)
+        out[:] = self.matrix.toarray()
+        f.close()
+
+        self.assertRaises(Exception, distr_chips_hdf5, "test.hdf5", self.states*self.states, out_name="out.hdf5")
+
+        hdf5_compute_stats("test.hdf5")
+        distr_chips_hdf5("test.hdf5", self.states*self.states, out_name="out.hdf5")
+
+        h5 = tb.open_file("out.hdf5", 'r')
+        ret2 = csr_matrix((h5.root.data[:], h5.root.indices[:], h5.root.indptr[:]), shape=self.matrix.shape)
+        np.testing.assert_array_equal(ret1.toarray(), ret2.toarray())
+        h5.close()
+
+        os.remove("test.hdf5")
+        os.remove("out.hdf5")
+
+    def test_elicit(self):
+        from hyptrails.elicitation import elicit, estimate_footprint, hdf5_has_stats
+
+        ret1 = distr_chips(self.matrix.copy(), self.states*self.states)
+
+        ret2, engine = elicit(self.matrix.copy(), self.states*self.states)
+        self.assertEqual(engine, "distr_chips")
+        np.testing.assert_array_equal(ret1.toarray(), ret2.toarray())
+
+        # too little memory for the in-memory path; the matrix is spilled to disk
+        ret2, engine = elicit(self.matrix.copy(), self.states*self.states, memory_budget=self.matrix.nnz*40,
+                              out_name="out.hdf5")
+        self.assertEqual(engine, "distr_chips_hdf5_sparse")
+        h5 = tb.open_file(ret2, 'r')
+        ret2 = csr_matrix((h5.root.data[:], h5.root.indices[:], h5.root.indptr[:]), shape=self.matrix.shape)
+        h5.close()
+        np.testing.assert_array_equal(ret1.toarray(), ret2.toarray())
+        os.remove("out.hdf5")
+
+        hdf5_save(self.matrix, "test.hdf5")
+        ret2, engine = elicit("test.hdf5", self.states*self.states)
+        self.assertEqual(engine, "distr_chips")
+        np.testing.assert_array_equal(ret1.toarray(), ret2.toarray())
+        os.remove("test.hdf5")
+
+        ret3 = distr_chips_row(self.matrix.copy(), self.states)
+        ret2, engine = elicit(self.matrix.copy(), self.states, row_based=True, n_jobs=1)
+        self.assertEqual(engine, "distr_chips_row")
+        np.testing.assert_array_equal(ret3.toarray(), ret2.toarray())
+
+        self.assertRaises(Exception, elicit, self.matrix, self.states, row_based=True, memory_budget=1)
+
+        # dense file without statistics; the input file is not modified
+        filters = tb.Filters(complevel=5, complib='blosc')
+        f = tb.open_file("test.hdf5", 'w')
+        out = f.create_carray(f.root, 'data', tb.Float64Atom(), shape=self.matrix.shape, filters=filters)
+        out[:] = self.matrix.toarray()
+        f.close()
+        budget = estimate_footprint("distr_chips_hdf5", self.matrix.shape, self.states*self.states)
+        ret2, engine = elicit("test.hdf5", self.states*self.states, memory_budget=budget, out_name="out.hdf5")
+        self.assertEqual(engine, "distr_chips_hdf5")
+        h5 = tb.open_file(ret2, 'r')
+        ret2 = csr_matrix((h5.root.data[:], h5.root.indices[:], h5.root.indptr[:]), shape=self.matrix.shape)
+        h5.close()
+        np.testing.assert_array_equal(ret1.toarray(), ret2.toarray())
+        self.assertFalse(hdf5_has_stats("test.hdf5"))
+        os.remove("test.hdf5")
+        os.remove("out.hdf5")
+
+        # sparse file without statistics whose last columns are empty; the matrix is taken to be square
+        sparse = csr_matrix(np.array([[1., 2., 0., 0.], [0., 3., 0., 0.], [0., 0., 0., 0.], [4., 0., 0., 0.]]))
+        f = tb.open_file("test.hdf5", 'w')
+        for name in ['data', 'indices', 'indptr']:
+            arr = getattr(sparse, name)
+            out = f.create_carray(f.root, name, tb.Atom.from_dtype(arr.dtype), shape=arr.shape, filters=filters)
+            out[:] = arr
+        f.close()
+        ret2, engine = elicit("test.hdf5", 12)
+        self.assertEqual(engine, "distr_chips")
+        self.assertEqual(ret2.shape, (4, 4))
+        np.testing.assert_array_equal(distr_chips(sparse.copy(), 12).toarray(), ret2.toarray())
+        ret2, engine = elicit("test.hdf5", 12, shape=(4, 5))
+        self.assertEqual(ret2.shape, (4, 5))
+        os.remove("test.hdf5")
+
+    def test_grouped_evidence(self):
+        from hyptrails.evidence import grouped_transition_counts, transition_counts, grouped_evidence, \
+            marginal_likelihood
+        from scipy.special import gammaln
+
+        trails = []
+        with open("../data/test_case_4") as f:
+            for line in f:
+                if line.strip() == "":
+                    continue
+                line = line.strip().split(" ")
+                # split the single long trail into shorter ones
+                trails.extend(line[i:i+7] for i in xrange(0, len(line), 7))
+
+        vocab = dict(((t, i) for i, t in enumerate(sorted(set(s for t in trails for s in t)))))
+        groups = [i % 3 for i in xrange(len(trails))]
+
+        A = rand(5, 5, density=0.5, format='csr')
+        priors = {("random", 1): distr_chips_row(A.copy(), 5, n_jobs=1),
+                  ("random", 2): distr_chips_row(A.copy(), 10, n_jobs=1),
+                  ("uniform", 1): distr_chips(csr_matrix(np.ones((5,5))), 25),
+                  ("flat", 0): None}
+
+        counts, group_ids = grouped_transition_counts(trails, groups, vocab)
+        self.assertEqual(counts.shape, (15, 5))
+        self.assertEqual(group_ids, [0, 1, 2])
+
+        ret = grouped_evidence(counts, priors)
+
+        for key, prior in priors.iteritems():
+            for g in group_ids:
+                c = transition_counts([t for t, x in zip(trails, groups) if x == g], vocab).toarray()
+                alpha = 1. + (np.zeros((5,5)) if prior is None else prior.toarray())
+                evi = (gammaln(alpha.sum(axis=1)) - gammaln(alpha.sum(axis=1) + c.sum(axis=1))
+                       + (gammaln(alpha + c) - gammaln(alpha)).sum(axis=1)).sum()
+                self.assertAlmostEqual(ret[key][g], evi)
+
+        # uniform chips are equivalent to a higher flat prior
+        counts = transition_counts(trails, vocab)
+        self.assertAlmostEqual(marginal_likelihood(counts, priors[("uniform", 1)]),
+                               marginal_likelihood(counts, None, flat_prior=2.))
+
+    def test_hdf5_grouped_evidence(self):
+        from hyptrails.evidence import grouped_evidence, hdf5_grouped_evidence, hdf5_marginal_likelihood
+        from hyptrails.hdf5 import hdf5_save
+
+        A = rand(300, 300, density=0.05, format='csr', random_state=3)
+        prior = distr_chips_row(A, 100, n_jobs=1)
+        counts = rand(900, 300, density=0.02, format='csr', random_state=4)
+        counts.data = np.ceil(counts.data * 5)
+
+        hdf5_save(prior, "prior.hdf5")
+        ret = grouped_evidence(counts, {0: prior})[0]
+        np.testing.assert_array_almost_equal(hdf5_grouped_evidence(counts, "prior.hdf5"), ret)
+        # many small blocks
+        np.testing.assert_array_almost_equal(hdf5_grouped_evidence(counts, "prior.hdf5", block_size=500), ret)
+        self.assertAlmostEqual(hdf5_marginal_likelihood(counts[:300], "prior.hdf5", flat_prior=2., block_size=500),
+                               grouped_evidence(counts[:300], {0: prior}, flat_prior=2.)[0][0])
+
+        # prior without stored statistics
+        f = tb.open_file("prior.hdf5", 'a')
+        f.remove_node(f.root, 'row_sums')
+        del f.root._v_attrs.matrix_sum
+        f.close()
+        np.testing.assert_array_almost_equal(hdf5_grouped_evidence(counts, "prior.hdf5", block_size=500), ret)
+
+        self.assertRaises(Exception, hdf5_grouped_evidence, counts[:400, :200], "prior.hdf5")
+
+        os.remove("prior.hdf5")
+
+    def test_mixture_evidence(self):
+        from hyptrails.mixture import weight_grid, mixture_priors, mixture_evidence
+        from hyptrails.evidence import marginal_likelihood
+        from sklearn.preprocessing import normalize
+
+        components = [rand(self.states, self.states, density=0.1, format='csr') for _ in xrange(2)]
+        # every row needs some belief as distr_chips_row randomly distributes chips in empty rows
+        components[0] = components[0] + csr_matrix((np.ones(self.states), (np.arange(self.states),
+                                                    np.arange(self.states))), shape=(self.states, self.states))
+        weights = weight_grid(2, steps=4)
+        self.assertEqual(weights.shape, (5, 2))
+
+        counts = rand(self.states, self.states, density=0.2, format='csr')
+        counts.data = np.ceil(counts.data * 10)
+
+        for mode in ["integers", "reals"]:
+            priors = mixture_priors(components, weights, self.states, mode=mode)
+            best, evidences = mixture_evidence(components, weights, counts, self.states, mode=mode)
+
+            for w, prior, evi in zip(weights, priors, evidences):
+                mixed = w[0] * normalize(components[0], norm='l1') + w[1] * normalize(components[1], norm='l1')
+                ret = distr_chips_row(mixed.tocsr(), self.states, n_jobs=1, mode=mode)
+                np.testing.assert_array_almost_equal(prior.toarray(), ret.toarray())
+                self.assertAlmostEqual(evi, marginal_likelihood(counts, ret))
+
+            np.testing.assert_array_equal(best, weights[np.argmax(evidences)])
+
+            # a budget too small for more than one weight vector at a time
+            ret = mixture_evidence(components, weights, counts, self.states, mode=mode, memory_budget=1)[1]
+            np.testing.assert_array_almost_equal(evidences, ret)
+
+    def test_distr_chips_row_blocks(self):
+        from hyptrails.pipeline import row_blocks
+
+        # power-law row lengths
+        lengths = np.minimum((np.random.pareto(1., self.states) + 1).astype(int), self.states)
+        rows = np.repeat(np.arange(self.states), lengths)
+        cols = np.concatenate([np.random.choice(self.states, l, replace=False) for l in lengths])
+        m = csr_matrix((np.random.rand(len(rows)), (rows, cols)), shape=(self.states, self.states))
+
+        blocks = row_blocks(m.indptr, 8)
+        self.assertEqual(blocks[0][0], 0)
+        self.assertEqual(blocks[-1][1], self.states)
+        for (s1, e1), (s2, e2) in zip(blocks[:-1], blocks[1:]):
+            self.assertEqual(e1, s2)
+
+        ret1 = distr_chips_row(m.copy(), self.states, n_jobs=1)
+        for n_jobs in [1, 2]:
+            ret2 = distr_chips_row(m.copy(), self.states, n_jobs=n_jobs, scheduler="blocks")
+            self.assertEqual(ret2.dtype, ret1.dtype)
+            np.testing.assert_array_equal(ret1.toarray(), ret2.toarray())
+
+        m[0,:] = 0.
+        m.eliminate_zeros()
+        ret = distr_chips_row(m, self.states, n_jobs=2, scheduler="blocks")
+        self.assertEqual(ret.sum(), self.states*self.states)
+
+    def test_distr_chips_row_dedupe(self):
+        from hyptrails.patterns import expand_patterns, row_patterns
+        from hyptrails.evidence import marginal_likelihood
+
+        # 10 distinct rows, each repeated 10 times (some scaled, which normalizes to the same pattern)
+        base = rand(10, self.states, density=0.2, format='csr')
+        m = vstack([base * (1 + i % 3) for i in xrange(10)]).tocsr()
+
+        table, row_pattern = distr_chips_row(m.copy(), self.states, n_jobs=1, dedupe=True)
+        self.assertEqual(table.shape, (10, self.states))
+        np.testing.assert_array_equal(row_pattern, np.tile(np.arange(10), 10))
+
+        ret = distr_chips_row(m.copy(), self.states, n_jobs=1)
+        np.testing.assert_array_equal(expand_patterns(table, row_pattern).toarray(), ret.toarray())
+
+        counts = rand(self.states, self.states, density=0.2, format='csr')
+        counts.data = np.ceil(counts.data * 10)
+        self.assertAlmostEqual(marginal_likelihood(counts, (table, row_pattern)), marginal_likelihood(counts, ret))
+
+        # the input is not modified (duplicate entries stay as they are)
+        dup = csr_matrix((np.ones(3), np.array([0, 0, 1]), np.array([0, 2, 3, 3])), shape=(3, 3))
+        row_patterns(dup)
+        self.assertEqual(dup.nnz, 3)
+        self.assertFalse(dup.has_canonical_format)
+
+        # rows without any belief get their own random leftover chips, just as without dedupe
+        m = vstack([base, csr_matrix((5, self.states)), base]).tocsr()
+        table, row_pattern = distr_chips_row(m.copy(), self.states * 1.5, n_jobs=1, dedupe=True)
+        self.assertEqual(len(set(row_pattern[10:15])), 5)
+        np.testing.assert_array_equal(row_pattern[15:], row_pattern[:10])
+        expanded = expand_patterns(table, row_pattern)
+        np.testing.assert_array_equal(expanded.sum(axis=1).A1, np.repeat(self.states * 1.5, 25))
+        table, row_pattern = distr_chips_row(m.copy(), self.states * 1.5, n_jobs=1, dedupe=True,
+                                             dist_zero_rows=False)
+        self.assertEqual(len(set(row_pattern[10:15])), 1)
+
+    def test_synthetic_trails(self):
+        from hyptrails.synthetic import generate_trails, write_trails, trail_counts
+        from hyptrails.evidence import transition_counts
+
+        A = rand(50, 50, density=0.1, format='csr', random_state=5)
+        A[7] = 0
+
+        trails = list(generate_trails(A, 1000, (2, 20), seed=1, batch_size=300))
+        self.assertEqual(len(trails), 1000)
+        for t in trails:
+            self.assertTrue(1 <= len(t) <= 20)
+            # walkers only use stored transitions and stop in rows without any weight
+            for i in xrange(len(t) - 1):
+                self.assertTrue(A[t[i], t[i+1]] > 0)
+            if len(t) < 2:
+                self.assertEqual(A[t[0]].sum(), 0)
+        np.testing.assert_array_equal(np.concatenate(trails),
+                                      np.concatenate(list(generate_trails(A, 1000, (2, 20), seed=1, batch_size=300))))
+
+        vocab = dict((i, i) for i in xrange(50))
+        counts = trail_counts(A, 1000, (2, 20), seed=1, batch_size=300)
+        np.testing.assert_array_equal(counts.toarray(), transition_counts(trails, vocab, 50).toarray())
+
+        transitions = write_trails("trails.txt", A, 1000, (2, 20), seed=1, batch_size=300)
+        with open("trails.txt") as f:
+            lines = [line.strip().split(" ") for line in f]
+        self.assertEqual(lines, [[str(s) for s in t] for t in trails])
+        self.assertEqual(transitions, counts.sum())
+        os.remove("trails.txt")
+
+        # the input matrix is not modified
+        dup = csr_matrix((np.array([1., 2., 3.]), np.array([1, 1, 0]), np.array([0, 2, 3, 3, 3, 3])), shape=(5, 5))
+        trail_counts(dup, 5, 3, seed=1)
+        self.assertEqual(dup.nnz, 3)
+        self.assertFalse(dup.has_canonical_format)
+
+        # transition frequencies follow the row-normalized weights
+        B = csr_matrix(np.array([[1., 3.], [2., 2.]]))
+        counts = trail_counts(B, 1000, 101, seed=2, start=np.zeros(1000, dtype=int)).toarray()
+        self.assertEqual(counts.sum(), 100000)
+        np.testing.assert_array_almost_equal(counts / counts.sum(axis=1)[:, None], [[0.25, 0.75], [0.5, 0.5]],
+                                             decimal=2)
+
+    def test_pipeline(self):
+        from hyptrails.pipeline import block_rows, read_blocks, BlockWriter
+
+        values = np.random.rand(10000, 3)
+        f = tb.open_file("test.hdf5", 'w')
+        data = f.create_carray(f.root, 'data', tb.Float64Atom(), shape=values.shape, chunkshape=(100, 3))
+        data[:] = values
+        out = f.create_carray(f.root, 'out', tb.Float64Atom(), shape=values.shape)
+
+        self.assertEqual(block_rows(data, target_bytes=10000), 400)
+        self.assertEqual(block_rows(data, target_bytes=10), 100)
+
+        writer = BlockWriter()
+        blocks = []
+        for i, block in read_blocks(data, 50, 9990, 400, prefetch=3):
+            self.assertEqual(i, 50 + 400 * len(blocks))
+            blocks.append(block.copy())
+            writer.write(out, i, block * 2)
+        writer.close()
+
+        np.testing.assert_array_equal(np.concatenate(blocks), values[50:9990])
+        np.testing.assert_array_equal(out[50:9990], values[50:9990] * 2)
+        self.assertEqual(list(read_blocks(data, 50, 50, 400)), [])
+
+        f.close()
+        os.remove("test.hdf5")
+
+        # the result does not depend on the block size
+        matrix = rand(300, 300, density=0.05, format='csr', random_state=6)
+        ret1 = distr_chips(matrix, 1000)
+        hdf5_save(matrix, "test.hdf5")
+        for bl in [None, 1, 777]:
+            distr_chips_hdf5_sparse("test.hdf5", 1000, out_name="out.hdf5", block_size=bl)
+            h5 = tb.open_file("out.hdf5", 'r')
+            ret2 = csr_matrix((h5.root.data[:], h5.root.indices[:], h5.root.indptr[:]), shape=matrix.shape)
+            h5.close()
+            np.testing.assert_array_equal(ret1.toarray(), ret2.toarray())
+
+        os.remove("test.hdf5")
+        os.remove("out.hdf5")
+
+    def test_distr_chips_hdf5_resume(self):
+        from hyptrails import hdf5
+        from hyptrails.elicitation import hdf5_load
+
+        def interrupt_at(phase, cursor):
+            # progress hook that interrupts the run once it reaches the given phase and cursor
+            def progress(p, c):
+                if p == phase and c == cursor:
+                    raise KeyboardInterrupt
+            return progress
+
+        matrix = rand(500, 500, density=0.02, format='csr', random_state=1)
+        chips = 1000
+        hdf5.hdf5_save(matrix, "test.hdf5")
+
+        hdf5.distr_chips_hdf5_sparse("test.hdf5", chips, out_name="out.hdf5")
+        h5 = tb.open_file("out.hdf5", 'r')
+        ret1 = h5.root.data[:]
+        row_sums1 = h5.root.row_sums[:]
+        h5.close()
+
+        # interrupted after three blocks (the last checkpoint is after the second one), resumed with
+        # different parameters, interrupted before the result is written and finally resumed
+        self.assertRaises(KeyboardInterrupt, hdf5.distr_chips_hdf5_sparse, "test.hdf5", chips, out_name="out.hdf5",
+                          checkpoint_every=2, block_size=1000, progress=interrupt_at("scan", 3000))
+        self.assertRaises(Exception, hdf5.distr_chips_hdf5_sparse, "test.hdf5", chips + 1, out_name="out.hdf5",
+                          resume=True)
+        self.assertRaises(KeyboardInterrupt, hdf5.distr_chips_hdf5_sparse, "test.hdf5", chips, out_name="out.hdf5",
+                          resume=True, block_size=1000, progress=interrupt_at("finalize", matrix.nnz))
+        hdf5.distr_chips_hdf5_sparse("test.hdf5", chips, out_name="out.hdf5", resume=True, block_size=1000)
+
+        h5 = tb.open_file("out.hdf5", 'r')
+        self.assertFalse('checkpoint' in h5.root)
+        np.testing.assert_array_equal(h5.root.data[:], ret1)
+        np.testing.assert_array_equal(h5.root.row_sums[:], row_sums1)
+        h5.close()
+
+        # finished outputs are not repeated, but only if they were written with the same parameters
+        hdf5.distr_chips_hdf5_sparse("test.hdf5", chips, out_name="out.hdf5", resume=True)
+        self.assertRaises(Exception, hdf5.distr_chips_hdf5_sparse, "test.hdf5", chips + 1, out_name="out.hdf5",
+                          resume=True)
+        self.assertRaises(Exception, hdf5.distr_chips_hdf5_sparse, "test.hdf5", chips, out_name="out.hdf5",
+                          norm=False, resume=True)
+        os.remove("test.hdf5")
+        os.remove("out.hdf5")
+
+        filters = tb.Filters(complevel=5, complib='blosc')
+        f = tb.open_file("test.hdf5", 'w')
+        out = f.create_carray(f.root, 'data', tb.Float64Atom(), shape=(4500, 20), filters=filters)
+        out[:] = rand(4500, 20, density=0.3, random_state=2).toarray()
+        f.close()
+        hdf5.hdf5_compute_stats("test.hdf5")
+
+        hdf5.distr_chips_hdf5("test.hdf5", chips, out_name="out.hdf5")
+        ret1 = hdf5_load("out.hdf5", (4500, 20))
+
+        self.assertRaises(KeyboardInterrupt, hdf5.distr_chips_hdf5, "test.hdf5", chips, out_name="out.hdf5",
+                          checkpoint_every=2, block_size=1000, progress=interrupt_at("scan", 3000))
+        self.assertRaises(KeyboardInterrupt, hdf5.distr_chips_hdf5, "test.hdf5", chips, out_name="out.hdf5",
+                          resume=True, block_size=1000, progress=interrupt_at("finalize", 4500))
+        hdf5.distr_chips_hdf5("test.hdf5", chips, out_name="out.hdf5", resume=True, block_size=1000)
+
+        ret2 = hdf5_load("out.hdf5", (4500, 20))
+        np.testing.assert_array_equal(ret1.toarray(), ret2.toarray())
+        self.assertRaises(Exception, hdf5.distr_chips_hdf5, "test.hdf5", chips + 1, out_name="out.hdf5", resume=True)
+
+        os.remove("test.hdf5")
+        os.remove("out.hdf5")
+
     def test_distr_chips_hdf5(self):
         filters = tb.Filters(complevel=5, complib='blosc')
         atom = tb.Atom.from_dtype(self.matrix.dtype)